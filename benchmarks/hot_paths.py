@@ -0,0 +1,356 @@
+"""Benchmark the hot paths of the mining pipeline on synthetic data."""
+import argparse
+from collections import namedtuple
+import json
+import logging
+from pathlib import Path
+import resource
+import sys
+import tempfile
+import threading
+import time
+from typing import Callable, Dict, Iterator, List
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from sourced.ml.mining.models import Dependencies
+from sourced.ml.mining.utils import (
+    create_swivel_inputs,
+    deps_coocs_matrix,
+    extract_dependencies,
+    merge_dependencies,
+)
+
+LANGS = ["go", "java", "python"]
+Packet = namedtuple("Packet", ["block"])
+
+
+def power_law_matrix(
+    num_files: int, num_deps: int, mean_deps: float, exponent: float, seed: int
+) -> csr_matrix:
+    """
+    Generate a binary file-dependency matrix.
+
+    The number of dependencies of each file follows a geometric distribution, and the popularity
+    of dependencies a power law.
+    """
+    rng = np.random.RandomState(seed)
+    counts = np.minimum(rng.geometric(1 / mean_deps, size=num_files), num_deps)
+    popularity = np.arange(1, num_deps + 1, dtype=np.float64) ** -exponent
+    popularity /= popularity.sum()
+    rows = np.repeat(np.arange(num_files), counts)
+    cols = rng.choice(num_deps, size=len(rows), p=popularity)
+    matrix = csr_matrix(
+        (np.ones(len(rows), dtype=bool), (rows, cols)), shape=(num_files, num_deps)
+    )
+    matrix.sum_duplicates()
+    return matrix
+
+
+class FakeBlock:
+    """Data block as decoded by clickhouse_driver with strings_as_bytes set."""
+
+    def __init__(self, columns: List[tuple]):
+        """Create the block from its columns."""
+        self.columns = columns
+        self.rows = len(columns[0])
+
+    def get_columns(self) -> List[tuple]:
+        """Return the columns of the block."""
+        return self.columns
+
+
+class FakeConnection:
+    """No-op stand-in for clickhouse_driver.connection.Connection."""
+
+    def force_connect(self):
+        """Do nothing."""
+
+    def send_query(self, query: str):
+        """Do nothing."""
+
+    def send_external_tables(self, tables):
+        """Do nothing."""
+
+
+class FakeClient:
+    """
+    Local stand-in for clickhouse_driver.Client.
+
+    It streams the (repo, file, dependency) rows of the files of one language in a synthetic
+    matrix, in blocks like the server does.
+    """
+
+    def __init__(self, matrix: csr_matrix, rows: np.ndarray, block_size: int):
+        """Create the client streaming the given rows of the matrix."""
+        self.connection = FakeConnection()
+        self.matrix = matrix
+        self.rows = rows
+        self.block_size = block_size
+        self.last_query = None
+
+    def make_query_settings(self, settings: dict):
+        """Do nothing."""
+
+    def disconnect(self):
+        """Do nothing."""
+
+    def packet_generator(self) -> Iterator[Packet]:
+        """Yield the header block, then the blocks of rows."""
+        # The header block has no rows
+        yield Packet(FakeBlock([(), (), ()]))
+        matrix = self.matrix[self.rows]
+        files = np.repeat(self.rows, np.diff(matrix.indptr))
+        deps = matrix.indices
+        for start in range(0, len(files), self.block_size):
+            block_files = files[start:start + self.block_size].tolist()
+            yield Packet(
+                FakeBlock(
+                    [
+                        tuple(b"repo-%d" % (file // 100) for file in block_files),
+                        tuple(b"file-%d.ext" % file for file in block_files),
+                        tuple(b"dep-%d" % dep for dep in deps[start:start + self.block_size]),
+                    ]
+                )
+            )
+
+
+class PeakRSSSampler(threading.Thread):
+    """Thread sampling the resident set size of the process to measure the peak of a stage."""
+
+    def __init__(self, interval: float = 0.01):
+        """Create the sampler, which samples every interval seconds once started."""
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak = 0
+        self._stop_event = threading.Event()
+
+    @staticmethod
+    def rss() -> int:
+        """Return the current resident set size in bytes."""
+        try:
+            with open("/proc/self/statm") as fin:
+                return int(fin.read().split()[1]) * resource.getpagesize()
+        except OSError:
+            # ru_maxrss is in kilobytes on Linux, and is the peak of the whole process
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def run(self):
+        """Sample until stopped."""
+        while not self._stop_event.is_set():
+            self.peak = max(self.peak, self.rss())
+            self._stop_event.wait(self.interval)
+
+    def stop(self) -> int:
+        """Stop sampling and return the peak resident set size in bytes."""
+        self._stop_event.set()
+        self.join()
+        return max(self.peak, self.rss())
+
+
+def measure(stage: Callable[[], Dict], repeat: int) -> Dict:
+    """
+    Run a stage several times and return its measurements.
+
+    They are the best time, the peak RSS and the metrics returned by the stage, including the
+    number of items it processed to compute its throughput.
+    """
+    times, peak = [], 0
+    for _ in range(repeat):
+        sampler = PeakRSSSampler()
+        sampler.start()
+        start = time.perf_counter()
+        metrics = stage()
+        times.append(time.perf_counter() - start)
+        peak = max(peak, sampler.stop())
+    result = {"seconds": min(times), "peak_rss": peak}
+    result.update(metrics)
+    if "items" in result:
+        result["throughput"] = result["items"] / result["seconds"]
+    return result
+
+
+def directory_size(path: Path) -> int:
+    """Return the total size of the files in a directory."""
+    return sum(p.stat().st_size for p in path.rglob("*") if p.is_file())
+
+
+def run_benchmarks(args: argparse.Namespace, log: logging.Logger) -> Dict:
+    """
+    Run all the stages on the same synthetic data and return their results.
+
+    Each stage uses the output of the previous one.
+    """
+    matrix = power_law_matrix(
+        args.files, args.deps, args.mean_deps, args.exponent, args.seed
+    )
+    log.info("Generated %d x %d matrix with %d entries", *matrix.shape, matrix.nnz)
+    langs = np.arange(args.files) % len(LANGS)
+    results = {}
+    state = {}
+
+    def extract():
+        parts = [
+            extract_dependencies(
+                FakeClient(matrix, np.flatnonzero(langs == code), args.block_size),
+                "",
+                lang,
+                {},
+                args.prefetch,
+            )
+            for code, lang in enumerate(LANGS)
+        ]
+        state["model"] = Dependencies().construct(*merge_dependencies(parts))
+        return {"items": matrix.nnz, "unit": "rows/s"}
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+
+        def save(compress):
+            def stage():
+                path = tmpdir / ("deps-%s.asdf" % ("compressed" if compress else "raw"))
+                state["model"].save(
+                    str(path), series="deps", compress=compress, threads=args.workers
+                )
+                return {"items": matrix.nnz, "unit": "entries/s", "size": path.stat().st_size}
+
+            return stage
+
+        def load(compress, lazy):
+            def stage():
+                path = tmpdir / ("deps-%s.asdf" % ("compressed" if compress else "raw"))
+                model = Dependencies().load(str(path), lazy=lazy, threads=args.workers)
+                # Read the whole matrix and decode a string so that lazy loading is not free, and
+                # report the results to check that every load returns the same model
+                return {
+                    "items": matrix.nnz,
+                    "unit": "entries/s",
+                    "indices_sum": int(model.csr.indices.sum()),
+                    "last_file": model.files[len(model.files) - 1],
+                }
+
+            return stage
+
+        def coocs():
+            state["coocs"] = deps_coocs_matrix(
+                state["model"].matrix, log, block_size=args.coocs_block_size
+            )
+            return {"items": state["coocs"].nnz, "unit": "coocs/s"}
+
+        def swivel():
+            output_dir = tmpdir / "swivel"
+            output_dir.mkdir(exist_ok=True)
+            tokens = ["dep-%d" % ind for ind in range(state["coocs"].shape[0])]
+            create_swivel_inputs(
+                output_dir, log, state["coocs"], args.shard_size, tokens, workers=args.workers
+            )
+            return {
+                "items": state["coocs"].nnz,
+                "unit": "coocs/s",
+                "size": directory_size(output_dir),
+            }
+
+        stages = [
+            ("extract", extract),
+            ("save_compressed", save(True)),
+            ("save_uncompressed", save(False)),
+            ("load_compressed", load(True, False)),
+            ("load_lazy", load(False, True)),
+            ("coocs", coocs),
+            ("swivel", swivel),
+        ]
+        for name, stage in stages:
+            if args.stages and name not in args.stages:
+                continue
+            results[name] = measure(stage, args.repeat)
+            log.info(
+                "%s: %.3fs, %.0f %s, peak RSS %.1f MB",
+                name,
+                results[name]["seconds"],
+                results[name].get("throughput", 0),
+                results[name].get("unit", ""),
+                results[name]["peak_rss"] / (1 << 20),
+            )
+    return results
+
+
+def compare(results: Dict, baseline: Dict, log: logging.Logger):
+    """Log the relative change of the time, peak RSS and size of each stage to a baseline."""
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for key in ("seconds", "peak_rss", "size"):
+            if key in result and baseline[name].get(key):
+                change = result[key] / baseline[name][key] - 1
+                log.info("%s %s: %+.1f%%", name, key, change * 100)
+
+
+def parse_args() -> argparse.Namespace:
+    """
+    Create the cmdline argument parser.
+    """
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("--files", default=200000, type=int, help="Number of files.")
+    parser.add_argument("--deps", default=20000, type=int, help="Number of dependencies.")
+    parser.add_argument(
+        "--mean-deps", default=8, type=float, help="Mean number of dependencies per file."
+    )
+    parser.add_argument(
+        "--exponent", default=1.1, type=float, help="Exponent of the dependency popularity."
+    )
+    parser.add_argument("--seed", default=7, type=int, help="Seed of the generators.")
+    parser.add_argument(
+        "--block-size", default=65536, type=int, help="Number of rows per fake block."
+    )
+    parser.add_argument(
+        "--prefetch", default=0, type=int, help="Number of fake blocks fetched ahead."
+    )
+    parser.add_argument(
+        "--coocs-block-size",
+        default=10000,
+        type=int,
+        help="Number of co-occurrence rows computed at once.",
+    )
+    parser.add_argument("--shard-size", default=1024, type=int, help="Size of Swivel shards.")
+    parser.add_argument(
+        "--workers", default=1, type=int, help="Number of worker processes or threads."
+    )
+    parser.add_argument("-n", "--repeat", default=3, type=int, help="Number of runs per stage.")
+    parser.add_argument("--stages", nargs="+", help="Stages to run, all of them if not set.")
+    parser.add_argument("--baseline", type=Path, help="Previous JSON results to compare to.")
+    parser.add_argument("-o", "--output", type=Path, help="Path to the JSON results.")
+    return parser.parse_args()
+
+
+def main():
+    """
+    Run the benchmarks, then write their results as JSON.
+
+    :return: The exit code.
+    """
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO)
+    log = logging.getLogger("hot_paths")
+    params = {
+        key: value
+        for key, value in vars(args).items()
+        if key not in ("baseline", "output", "stages")
+    }
+    report = {"params": params, "stages": run_benchmarks(args, log)}
+    if args.baseline:
+        with args.baseline.open() as fin:
+            compare(report["stages"], json.load(fin)["stages"], log)
+    if args.output:
+        with args.output.open("w") as fout:
+            json.dump(report, fout, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
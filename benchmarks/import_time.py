@@ -0,0 +1,97 @@
+"""Benchmark the startup time of the srcdmine entry point and check which modules it imports."""
+import argparse
+import json
+import logging
+import statistics
+import subprocess
+import sys
+import time
+
+# Dependencies which must only be imported by the commands which need them
+HEAVY_MODULES = ["clickhouse_driver", "scrapy", "twisted", "tqdm"]
+COMMANDS = {
+    "import": "import sourced.ml.mining.__main__",
+    "help": "import sys\n"
+    "from sourced.ml.mining.__main__ import main\n"
+    "sys.argv = ['srcdmine', '--help']\n"
+    "try:\n"
+    "    main()\n"
+    "except SystemExit:\n"
+    "    pass",
+}
+REPORT_MODULES = "\nimport json, sys\nprint(json.dumps(sorted(sys.modules)))"
+
+
+def parse_args() -> argparse.Namespace:
+    """
+    Create the cmdline argument parser.
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "-n", "--repeat", default=10, type=int, help="Number of runs of each command."
+    )
+    parser.add_argument(
+        "--max-seconds",
+        type=float,
+        help="Fail if the median time of any command exceeds this number of seconds.",
+    )
+    parser.add_argument("-o", "--output", help="Path to the JSON report, stdout if not set.")
+    return parser.parse_args()
+
+
+def run(code: str) -> float:
+    """Run the code in a fresh interpreter and return its wall time in seconds."""
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", code], check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def imported_modules(code: str) -> list:
+    """Run the code in a fresh interpreter and return the top-level modules it imported."""
+    output = subprocess.run(
+        [sys.executable, "-c", code + REPORT_MODULES],
+        check=True,
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+    ).stdout
+    return sorted({name.split(".")[0] for name in json.loads(output.splitlines()[-1])})
+
+
+def main():
+    """
+    Time each command, then fail if it imports a heavy dependency or is too slow.
+
+    :return: The exit code.
+    """
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO)
+    log = logging.getLogger("import_time")
+    report = {}
+    failed = False
+    for name, code in COMMANDS.items():
+        times = [run(code) for _ in range(args.repeat)]
+        heavy = sorted(set(imported_modules(code)).intersection(HEAVY_MODULES))
+        report[name] = {
+            "median": statistics.median(times),
+            "min": min(times),
+            "max": max(times),
+            "heavy_modules": heavy,
+        }
+        log.info("%s: median %.3fs over %d runs", name, report[name]["median"], args.repeat)
+        if heavy:
+            log.error("%s imports %s", name, ", ".join(heavy))
+            failed = True
+        if args.max_seconds is not None and report[name]["median"] > args.max_seconds:
+            log.error("%s takes more than %.3fs", name, args.max_seconds)
+            failed = True
+    if args.output:
+        with open(args.output, "w") as fout:
+            json.dump(report, fout, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+    return int(failed)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -5,10 +5,12 @@ import sys
 from modelforge import slogging
 
 from sourced.ml.mining.cmd import (
+    add_metrics_args,
     ArgumentDefaultsHelpFormatterNoNone,
-    clickhouse2deps,
     CLICKHOUSE_LANGS,
-    collect_stdlibs,
+    DEFAULT_CACHE_SIZE,
+    DEFAULT_PREFETCH,
+    get_handler,
 )
 
 
@@ -34,7 +36,7 @@ def parse_args() -> argparse.Namespace:
     clickhouse2deps_parser = add_parser(
         "clickhouse2deps", "Extract dependencies from a ClickHouse DB."
     )
-    clickhouse2deps_parser.set_defaults(handler=clickhouse2deps)
+    clickhouse2deps_parser.set_defaults(handler="clickhouse2deps")
     clickhouse2deps_parser.add_argument(
         "-o",
         "--output-path",
@@ -48,6 +50,12 @@ def parse_args() -> argparse.Namespace:
         help="Boolean indicating whether to overwrite the existing ASDF model specified by "
         "-o/--output-path.",
     )
+    clickhouse2deps_parser.add_argument(
+        "--uncompressed",
+        action="store_true",
+        help="Boolean indicating whether to save the model uncompressed, so that it can be "
+        "memory-mapped when loaded lazily.",
+    )
     clickhouse2deps_parser.add_argument(
         "--user", default="default", help="Username for the DB."
     )
@@ -73,13 +81,96 @@ def parse_args() -> argparse.Namespace:
         choices=CLICKHOUSE_LANGS,
         help="Languages to consider while extracting dependencies.",
     )
+    clickhouse2deps_parser.add_argument(
+        "--where",
+        help="Additional SQL condition on the rows of the table, e.g. to select new repositories "
+        "or partitions.",
+    )
+    clickhouse2deps_parser.add_argument(
+        "--base-model",
+        type=Path,
+        help="Path to an existing ASDF model with extracted dependencies: it is extended with "
+        "the new ones instead of being rebuilt.",
+    )
+    clickhouse2deps_parser.add_argument(
+        "--dictionary-encoding",
+        action="store_true",
+        help="Encode files and dependencies as integer ids on the server side: their "
+        "vocabularies are transferred once, then only the (file, dependency) id pairs. This "
+        "trades server time for bandwidth: the filtered sub-query, including the join of Java, "
+        "JavaScript and Python, is run three times per bucket, once for each vocabulary and "
+        "once for the pairs.",
+    )
+    clickhouse2deps_parser.add_argument(
+        "--resolution",
+        default="join",
+        choices=["join", "in"],
+        help="How the imported identifiers of Java, JavaScript and Python are resolved to their "
+        "paths: with a self-join of the table, or by filtering the paths with an IN on the set "
+        "of imports, which gives the same result without the join.",
+    )
+    clickhouse2deps_parser.add_argument(
+        "--checkpoint-dir",
+        type=Path,
+        help="Directory where the dependencies of each language bucket are saved as soon as they "
+        "are extracted.",
+    )
+    clickhouse2deps_parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Boolean indicating whether to skip the language buckets already saved in "
+        "--checkpoint-dir by a previous run with the same queries.",
+    )
+    clickhouse2deps_parser.add_argument(
+        "--cache-dir",
+        type=Path,
+        help="Directory where the dependencies of each language bucket are cached, keyed by "
+        "their query and the state of the parts of the table, so that they are not extracted "
+        "again while neither changes.",
+    )
+    clickhouse2deps_parser.add_argument(
+        "--cache-size",
+        default=DEFAULT_CACHE_SIZE,
+        type=int,
+        help="Maximum size of --cache-dir in MB, beyond which the least recently used results "
+        "are evicted.",
+    )
+    clickhouse2deps_parser.add_argument(
+        "--workers",
+        default=1,
+        type=int,
+        help="Number of worker processes, each running the query of one language bucket at a "
+        "time on its own connection to the DB.",
+    )
+    clickhouse2deps_parser.add_argument(
+        "--prefetch",
+        default=DEFAULT_PREFETCH,
+        type=int,
+        help="Number of result blocks read and decoded ahead by a background thread while the "
+        "previous ones are indexed, 0 to read them in the main thread.",
+    )
+    clickhouse2deps_parser.add_argument(
+        "--partitions",
+        default=1,
+        type=int,
+        help="Number of buckets the repositories of each language are split into by hash. Each "
+        "bucket is queried, checkpointed and retried on its own, which bounds the memory used by "
+        "the DB and by the client.",
+    )
+    clickhouse2deps_parser.add_argument(
+        "--retries",
+        default=0,
+        type=int,
+        help="Number of times the extraction of a language bucket is retried when it fails.",
+    )
+    add_metrics_args(clickhouse2deps_parser)
     # --------------------------------------------------------------------------------------------
 
     collect_stdlibs_parser = add_parser(
         "collect-stdlibs",
         "Collect the lists of standard libraries for each language Babelfish can parse.",
     )
-    collect_stdlibs_parser.set_defaults(handler=collect_stdlibs)
+    collect_stdlibs_parser.set_defaults(handler="collect_stdlibs")
     collect_stdlibs_parser.add_argument(
         "-o",
         "--output-path",
@@ -93,6 +184,160 @@ def parse_args() -> argparse.Namespace:
         help="Boolean indicating whether to overwrite the existing ASDF model specified by "
         "-o/--output-path.",
     )
+    collect_stdlibs_parser.add_argument(
+        "--cache-dir",
+        type=Path,
+        help="Directory where the HTTP responses are cached, and revalidated on the next runs.",
+    )
+    collect_stdlibs_parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="Boolean indicating whether to replay the responses cached in --cache-dir without "
+        "any network access.",
+    )
+    collect_stdlibs_parser.add_argument(
+        "--concurrency",
+        default=32,
+        type=int,
+        help="Maximum number of concurrent requests.",
+    )
+    collect_stdlibs_parser.add_argument(
+        "--workers",
+        default=1,
+        type=int,
+        help="Number of crawler processes the spiders are split across.",
+    )
+    # --------------------------------------------------------------------------------------------
+
+    deps2coocs_parser = add_parser(
+        "deps2coocs",
+        "Compute the co-occurrence matrix between dependencies from the extracted dependencies.",
+    )
+    deps2coocs_parser.set_defaults(handler="deps2coocs")
+    deps2coocs_parser.add_argument(
+        "-i",
+        "--input-path",
+        type=Path,
+        required=True,
+        help="Path to the ASDF model with the extracted dependencies.",
+    )
+    deps2coocs_parser.add_argument(
+        "-o",
+        "--output-path",
+        type=Path,
+        help="Output path to the resulting ASDF model with the co-occurrences, or to the "
+        "directory of the Swivel inputs if --swivel is set.",
+    )
+    deps2coocs_parser.add_argument(
+        "-f",
+        "--force",
+        action="store_true",
+        help="Boolean indicating whether to overwrite the existing output specified by "
+        "-o/--output-path.",
+    )
+    deps2coocs_parser.add_argument(
+        "--swivel",
+        action="store_true",
+        help="Boolean indicating whether to write the co-occurrences as Swivel inputs instead "
+        "of an ASDF model.",
+    )
+    deps2coocs_parser.add_argument(
+        "--langs",
+        nargs="+",
+        choices=CLICKHOUSE_LANGS,
+        help="Languages of the dependencies to consider, all of them if not specified.",
+    )
+    deps2coocs_parser.add_argument(
+        "--min-files",
+        default=1,
+        type=int,
+        help="Minimum number of files importing a dependency for it to be considered.",
+    )
+    deps2coocs_parser.add_argument(
+        "--min-coocs",
+        default=1,
+        type=int,
+        help="Minimum number of files importing two dependencies for their co-occurrence to be "
+        "kept.",
+    )
+    deps2coocs_parser.add_argument(
+        "--block-size",
+        default=10000,
+        type=int,
+        help="Number of rows of the co-occurrence matrix computed at once.",
+    )
+    deps2coocs_parser.add_argument(
+        "--shard-size",
+        default=4096,
+        type=int,
+        help="Size of the Swivel shards, i.e. the embedding batch size.",
+    )
+    deps2coocs_parser.add_argument(
+        "--spill-dir",
+        type=Path,
+        help="Directory where the co-occurrences are spilled by row shard while the Swivel "
+        "shards are created. They are computed block by block twice instead of being held in "
+        "memory, so that memory is bounded by --block-size and the size of a row shard.",
+    )
+    deps2coocs_parser.add_argument(
+        "--workers",
+        default=1,
+        type=int,
+        help="Number of worker processes computing the blocks of rows and writing the shards.",
+    )
+    add_metrics_args(deps2coocs_parser)
+    # --------------------------------------------------------------------------------------------
+
+    filter_stdlibs_parser = add_parser(
+        "filter-stdlibs",
+        "Remove or annotate the standard library dependencies of the extracted dependencies.",
+    )
+    filter_stdlibs_parser.set_defaults(handler="filter_stdlibs")
+    filter_stdlibs_parser.add_argument(
+        "-i",
+        "--input-path",
+        type=Path,
+        required=True,
+        help="Path to the ASDF model with the extracted dependencies.",
+    )
+    filter_stdlibs_parser.add_argument(
+        "-s",
+        "--stdlib-path",
+        type=Path,
+        required=True,
+        help="Path to the ASDF model with the collected standard libraries.",
+    )
+    filter_stdlibs_parser.add_argument(
+        "-o",
+        "--output-path",
+        type=Path,
+        help="Output path to the resulting ASDF model with the filtered dependencies.",
+    )
+    filter_stdlibs_parser.add_argument(
+        "-f",
+        "--force",
+        action="store_true",
+        help="Boolean indicating whether to overwrite the existing ASDF model specified by "
+        "-o/--output-path.",
+    )
+    filter_stdlibs_parser.add_argument(
+        "--annotate",
+        action="store_true",
+        help="Boolean indicating whether to keep the standard library dependencies and store "
+        "their mask in the model instead of removing them.",
+    )
+    filter_stdlibs_parser.add_argument(
+        "--exact",
+        action="store_true",
+        help="Boolean indicating whether dependencies must exactly match a standard library, "
+        "instead of having one as prefix.",
+    )
+    filter_stdlibs_parser.add_argument(
+        "--uncompressed",
+        action="store_true",
+        help="Boolean indicating whether to save the model uncompressed, so that it can be "
+        "memory-mapped when loaded lazily.",
+    )
     args = parser.parse_args()
     if not hasattr(args, "handler"):
         args.handler = lambda _: parser.print_usage()  # noqa: E731
@@ -103,10 +348,15 @@ def main():
     """
     Create all the argparse-rs and invokes the function from set_defaults().
 
+    Handlers given by name are only imported at this point, along with their dependencies.
+
     :return: The result of the function from set_defaults().
     """
     args = parse_args()
-    return args.handler(args)
+    handler = args.handler
+    if isinstance(handler, str):
+        handler = get_handler(handler)
+    return handler(args)
 
 
 if __name__ == "__main__":
@@ -1,5 +1,44 @@
 # flake8: noqa
-from sourced.ml.mining.cmd.args import ArgumentDefaultsHelpFormatterNoNone
-from sourced.ml.mining.cmd.clickhouse2deps import clickhouse2deps, CLICKHOUSE_LANGS
-from sourced.ml.mining.cmd.collect_stdlibs import collect_stdlibs
+import argparse
+from importlib import import_module
 
+from sourced.ml.mining.cmd.args import (
+    add_metrics_args,
+    ArgumentDefaultsHelpFormatterNoNone,
+    CLICKHOUSE_LANGS,
+    DEFAULT_CACHE_SIZE,
+    DEFAULT_PREFETCH,
+)
+
+# The handlers are only imported on dispatch, so that each command only pays for its own
+# dependencies
+HANDLERS = {
+    "clickhouse2deps": "sourced.ml.mining.cmd.clickhouse2deps",
+    "collect_stdlibs": "sourced.ml.mining.cmd.collect_stdlibs",
+    "deps2coocs": "sourced.ml.mining.cmd.deps2coocs",
+    "filter_stdlibs": "sourced.ml.mining.cmd.filter_stdlibs",
+}
+
+
+def get_handler(name: str):
+    """Import and return the handler of a command, given its name in HANDLERS."""
+    handler = getattr(import_module(HANDLERS[name]), name)
+    # Importing the module binds it to the name of its handler in the package
+    globals()[name] = handler
+    return handler
+
+
+def clickhouse2deps(args: argparse.Namespace):
+    return get_handler("clickhouse2deps")(args)
+
+
+def collect_stdlibs(args: argparse.Namespace):
+    return get_handler("collect_stdlibs")(args)
+
+
+def deps2coocs(args: argparse.Namespace):
+    return get_handler("deps2coocs")(args)
+
+
+def filter_stdlibs(args: argparse.Namespace):
+    return get_handler("filter_stdlibs")(args)
@@ -1,4 +1,17 @@
 import argparse
+from pathlib import Path
+
+CLICKHOUSE_LANGS = [
+    "cpp",
+    "csharp",
+    "go",
+    "java",
+    "javascript",
+    "php",
+    "python",
+]  # TODO(r0mainK): add ruby
+DEFAULT_CACHE_SIZE = 10240
+DEFAULT_PREFETCH = 2
 
 
 class ArgumentDefaultsHelpFormatterNoNone(argparse.ArgumentDefaultsHelpFormatter):
@@ -10,3 +23,26 @@ class ArgumentDefaultsHelpFormatterNoNone(argparse.ArgumentDefaultsHelpFormatter
         if action.default is None:
             return action.help
         return super()._get_help_string(action)
+
+
+def add_metrics_args(parser: argparse.ArgumentParser):
+    """
+    Add the arguments of the instrumentation of a command to its parser.
+    """
+    parser.add_argument(
+        "--metrics-json",
+        type=Path,
+        help="Path to the file where the metrics of each stage are appended as JSON lines.",
+    )
+    parser.add_argument(
+        "--metrics-prometheus",
+        type=Path,
+        help="Path to the file where the metrics of each stage are written in the Prometheus "
+        "text format, e.g. for the textfile collector of the node exporter.",
+    )
+    parser.add_argument(
+        "--profile",
+        type=Path,
+        help="Directory where the cProfile statistics and tracemalloc top allocations of each "
+        "stage are written.",
+    )
@@ -1,35 +1,94 @@
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import hashlib
+import json
 import logging
 from pathlib import Path
+from typing import Dict, Union
 
 from clickhouse_driver import Client
 import jinja2
-from scipy.sparse import coo_matrix
+import numpy as np
 import yaml
 
+from sourced.ml.mining.cmd.args import CLICKHOUSE_LANGS  # noqa: F401
 from sourced.ml.mining.models import Dependencies
-from sourced.ml.mining.utils import check_remove_filepath, path_with_suffix
+from sourced.ml.mining.utils import (
+    check_remove_filepath,
+    concat_language_dependencies,
+    extend_dependencies,
+    extract_dependencies,
+    extract_dependencies_process,
+    extract_encoded_dependencies,
+    get_metrics,
+    instrumented,
+    LanguageDependencies,
+    merge_dependencies,
+    path_with_suffix,
+    ResultCache,
+    table_fingerprint,
+)
 
 QUERY_TEMPLATE = "clickhouse2deps.sql.jinja2"
 QUERY_ARGS = "clickhouse2deps.yaml"
-CLICKHOUSE_LANGS = [
-    "cpp",
-    "csharp",
-    "go",
-    "java",
-    "javascript",
-    "php",
-    "python",
-]  # TODO(r0mainK): add ruby
 MAX_BLOCK_SIZE = 1000000
+# Each of them renders the whole filtered sub-query, which the server runs once per select
+ENCODED_SELECTS = ["files", "deps", "pairs"]
+CHECKPOINT_FILENAME = "%s.npz"
+BUCKET_NAME = "%s-%d-of-%d"
 
 
+def query_key(query: Union[str, Dict[str, str]]) -> str:
+    """Compute the key identifying the result of the query, or queries, of a language."""
+    return hashlib.sha1(json.dumps(query, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def bucket_name(lang: str, partition: int, partitions: int) -> str:
+    """Name a bucket of the repositories of a language, the language itself if not partitioned."""
+    if partitions <= 1:
+        return lang
+    return BUCKET_NAME % (lang, partition, partitions)
+
+
+def log_language_dependencies(log: logging.Logger, name: str, part: LanguageDependencies):
+    """Log the statistics of the dependencies extracted for a language bucket."""
+    log.info(
+        "Finished with %s, retrieved %d rows with %d distinct dependencies in %d files",
+        name,
+        part.num_rows,
+        len(part.deps),
+        len(part.files),
+    )
+
+
+def should_retry(log: logging.Logger, name: str, attempt: int, retries: int) -> bool:
+    """Log the failure of an extraction attempt and return whether to try again."""
+    if attempt >= retries:
+        return False
+    log.warning(
+        "Failed to extract %s, retrying (%d/%d)", name, attempt + 1, retries, exc_info=True
+    )
+    return True
+
+
+@instrumented
 def clickhouse2deps(args):
     """
     Extract dependencies from UASTs in a Clickhouse DB.
     """
     log = logging.getLogger("clickhouse2deps")
+    metrics = get_metrics()
+    base = None
+    if args.base_model is not None:
+        log.info("Loading the dependencies model to extend ...")
+        base = Dependencies(log_level=args.log_level).load(str(args.base_model))
     output_path = path_with_suffix(args.output_path, ".asdf")
     check_remove_filepath(output_path, log, args.force)
+    if args.resume and args.checkpoint_dir is None:
+        log.error("--resume requires --checkpoint-dir, aborting")
+        raise ValueError
+    if args.partitions < 1:
+        log.error("--partitions must be at least 1, aborting")
+        raise ValueError
 
     log.info("Loading the query template ...")
     root = Path(__file__).parent
@@ -39,63 +98,230 @@ def clickhouse2deps(args):
     log.info("Loading the query args ...")
     with (root / QUERY_ARGS).open() as fin:
         query_args = yaml.load(fin, Loader=yaml.BaseLoader)
-    client = Client(
+    client_args = dict(
         user=args.user,
         password=args.password,
         host=args.host,
         port=args.port,
         database=args.database,
     )
-    files, deps, ind_files, ind_deps = [], [], [], []
-    ind_to_langs, ind_to_repos, file_to_inds, dep_to_inds = {}, {}, {}, {}
-    for lang in args.langs:
-        log.info("Extracting %s dependencies...", lang)
-        rows = client.execute_iter(
-            template.render(lang=lang, table=args.table, query_args=query_args[lang]),
-            settings={"max_block_size": MAX_BLOCK_SIZE},
+    settings = {"max_block_size": MAX_BLOCK_SIZE}
+
+    def render(lang, partition, select=None):
+        return template.render(
+            lang=lang,
+            table=args.table,
+            query_args=query_args[lang],
+            select=select,
+            where=args.where,
+            partition=partition,
+            partitions=args.partitions,
+            resolution=args.resolution,
         )
-        num_rows, num_files, num_deps = 0, 0, 0
-        for row in rows:
-            row = [
-                e.decode("utf-8", errors="ignore") if not isinstance(e, str) else e
-                for e in row
-            ]
-            num_rows += 1
-            repo, file_path, dep = row
-            lang_file = ":".join([lang, repo, file_path])
-            lang_dep = ":".join([lang, dep])
-            if lang_file not in file_to_inds:
-                num_files += 1
-                file_to_inds[lang_file] = len(file_to_inds)
-                files.append(file_path)
-            ind_file = file_to_inds[lang_file]
-            ind_to_langs[ind_file] = lang
-            ind_to_repos[ind_file] = repo
-            ind_files.append(ind_file)
-            if lang_dep not in dep_to_inds:
-                num_deps += 1
-                dep_to_inds[lang_dep] = len(dep_to_inds)
-                deps.append(dep)
-            ind_deps.append(dep_to_inds[lang_dep])
+
+    # Each language is split into buckets of repositories, which are extracted, checkpointed and
+    # retried independently
+    buckets = [(lang, partition) for lang in args.langs for partition in range(args.partitions)]
+    names = [bucket_name(lang, partition, args.partitions) for lang, partition in buckets]
+    if args.dictionary_encoding:
+        extract = extract_encoded_dependencies
+        queries = [
+            {select: render(lang, partition, select) for select in ENCODED_SELECTS}
+            for lang, partition in buckets
+        ]
+    else:
+        extract = extract_dependencies
+        queries = [render(lang, partition) for lang, partition in buckets]
+    keys = [query_key(query) for query in queries]
+    parts = {}
+    if args.checkpoint_dir is not None:
+        args.checkpoint_dir.mkdir(parents=True, exist_ok=True)
+        if args.resume:
+            for name, key in zip(names, keys):
+                path = args.checkpoint_dir / (CHECKPOINT_FILENAME % name)
+                if not path.exists():
+                    continue
+                part, checkpoint_key = LanguageDependencies.load(path)
+                if checkpoint_key != key:
+                    log.warning(
+                        "%s was created with a different query, extracting %s again",
+                        path,
+                        name,
+                    )
+                    continue
+                log.info("Loaded %s dependencies from %s", name, path)
+                parts[name] = part
+    cache, cache_keys = None, {}
+    if args.cache_dir is not None:
+        log.info("Fingerprinting the state of the table ...")
+        database, _, table = args.table.rpartition(".")
+        client = Client(**client_args)
+        try:
+            fingerprint = table_fingerprint(client, database or args.database, table)
+        finally:
+            client.disconnect()
+        if fingerprint is None:
+            log.warning(
+                "%s has no active parts in system.parts, so its state is unknown: the results "
+                "will not be cached",
+                args.table,
+            )
+        else:
+            cache = ResultCache(args.cache_dir, args.cache_size << 20, log)
+            cache_keys = {
+                name: query_key({"query": query, "table": fingerprint})
+                for name, query in zip(names, queries)
+            }
+
+    def commit(name: str, part: LanguageDependencies, key: str, cached: bool = False):
+        log_language_dependencies(log, name, part)
+        parts[name] = part
+        if args.checkpoint_dir is not None:
+            path = args.checkpoint_dir / (CHECKPOINT_FILENAME % name)
+            part.save(path, key)
+            log.info("Saved the %s checkpoint to %s", name, path)
+        if cache is not None and not cached:
+            cache.put(cache_keys[name], part)
+
+    if cache is not None:
+        for name, key in zip(names, keys):
+            if name in parts:
+                continue
+            part = cache.get(cache_keys[name])
+            if part is not None:
+                log.info("Loaded %s dependencies from the cache", name)
+                commit(name, part, key, cached=True)
+
+    pending = [
+        (name, lang, partition, query, key)
+        for name, (lang, partition), query, key in zip(names, buckets, queries, keys)
+        if name not in parts
+    ]
+    if args.workers > 1:
         log.info(
-            "Finished with %s, retrieved %d rows with %d distinct dependencies in %d files",
-            lang,
-            num_rows,
-            num_deps,
-            num_files,
+            "Extracting dependencies of %d language buckets with %d workers...",
+            len(pending),
+            args.workers,
         )
+        with metrics.stage("extract", workers=args.workers) as stage, ProcessPoolExecutor(
+            max_workers=args.workers
+        ) as executor:
+            futures = {}
+
+            def submit(bucket, attempt):
+                _, lang, _, query, _ = bucket
+                future = executor.submit(
+                    extract_dependencies_process,
+                    client_args,
+                    extract,
+                    query,
+                    lang,
+                    settings,
+                    args.prefetch,
+                )
+                futures[future] = bucket, attempt
+
+            for bucket in pending:
+                submit(bucket, 0)
+            # Once a bucket fails for good, the buckets which are still running are committed
+            # before the error is raised, so that a resumed run does not extract them again
+            error = None
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    bucket, attempt = futures.pop(future)
+                    name, _, _, _, key = bucket
+                    if future.cancelled():
+                        continue
+                    try:
+                        part = future.result()
+                    except Exception as e:
+                        if error is not None:
+                            log.warning("Failed to extract %s", name, exc_info=True)
+                        elif should_retry(log, name, attempt, args.retries):
+                            submit(bucket, attempt + 1)
+                        else:
+                            error = e
+                            for other in futures:
+                                other.cancel()
+                        continue
+                    stage.add(rows=part.num_rows)
+                    commit(name, part, key)
+            if error is not None:
+                raise error
+    else:
+        client = Client(**client_args)
+        for name, lang, partition, query, key in pending:
+            log.info("Extracting %s dependencies...", name)
+            attempt = 0
+            while True:
+                try:
+                    with metrics.stage("extract", lang=lang, partition=partition) as stage:
+                        part = extract(client, query, lang, settings, args.prefetch)
+                        stage.set(
+                            files=len(part.files), deps=len(part.deps), repos=len(part.repos)
+                        )
+                    break
+                except Exception:
+                    client.disconnect()
+                    if not should_retry(log, name, attempt, args.retries):
+                        raise
+                    attempt += 1
+            commit(name, part, key)
+    log.info("Creating the sparse matrix ...")
+    with metrics.stage("merge") as stage:
+        if args.partitions > 1:
+            log.info("Merging the %d buckets of each language ...", args.partitions)
+        parts = [
+            concat_language_dependencies(
+                [
+                    parts.pop(bucket_name(lang, partition, args.partitions))
+                    for partition in range(args.partitions)
+                ]
+            )
+            for lang in args.langs
+        ]
+        if base is None:
+            matrix, files, deps, ind_to_langs, ind_to_repos = merge_dependencies(parts)
+        else:
+            matrix, files, deps, ind_to_langs, ind_to_repos = extend_dependencies(base, parts)
+        stage.set(
+            nnz=matrix.nnz,
+            files=len(files),
+            deps=len(deps),
+            repos=len(ind_to_repos.categories),
+        )
+    stdlib_mask = None
+    if base is not None:
+        log.info(
+            "Extended the model from %d to %d files and from %d to %d dependencies",
+            len(base.files),
+            len(files),
+            len(base.deps),
+            len(deps),
+        )
+        if base.stdlib_mask is not None:
+            # The dependencies of the base model keep their index, the new ones are appended
+            stdlib_mask = np.zeros(len(deps), dtype=bool)
+            stdlib_mask[:len(base.deps)] = base.stdlib_mask
+            if len(deps) > len(base.deps):
+                log.warning(
+                    "The %d new dependencies are not marked as standard libraries, run "
+                    "filter-stdlibs --annotate on the model to classify them",
+                    len(deps) - len(base.deps),
+                )
     log.info(
         "Done, retrieved %d rows with %d distinct dependencies in %d files and %d repos",
-        len(ind_files),
+        matrix.nnz,
         len(deps),
         len(files),
-        len(set(ind_to_repos.values())),
+        len(ind_to_repos.categories),
     )
-    log.info("Creating the sparse matrix ...")
-    matrix = coo_matrix(([True] * len(ind_files), (ind_files, ind_deps)), dtype=bool)
     log.info("Creating the dependencies model ...")
     model = Dependencies(log_level=args.log_level).construct(
-        matrix, files, deps, ind_to_langs, ind_to_repos
+        matrix, files, deps, ind_to_langs, ind_to_repos, stdlib_mask
     )
-    model.save(output_path, series="deps")
+    with metrics.stage("save") as stage:
+        model.save(output_path, series="deps", compress=not args.uncompressed)
+        stage.set(bytes=output_path.stat().st_size)
     log.info("Saved model to %s" % output_path)
@@ -1,5 +1,11 @@
 import argparse
 import logging
+import multiprocessing
+import os
+from pathlib import Path
+import tempfile
+import threading
+from typing import Dict, Iterable, List, Optional, Set, Tuple
 
 from scrapy.crawler import CrawlerProcess
 
@@ -14,52 +20,145 @@ from sourced.ml.mining.spiders import (
 )
 from sourced.ml.mining.utils import check_remove_filepath, path_with_suffix
 
+DEFAULT_CONCURRENCY = 32
+SPIDERS = [
+    CppStdlibSpider,
+    CSharpStdlibSpider,
+    GoStdlibSpider,
+    JavaStdlibSpider,
+    PythonStdlibSpider,
+    RubyStdlibSpider,
+]
 
-class StdlibPipeline(object):
-    """Item pipeline that holds data in memory then saves it as a StandardLibraries model."""
 
-    library_names = {}
-    library_metadata = {}
-    pending_spiders = 0
+class StdlibCollector(object):
+    """Thread-safe aggregation of the standard libraries found by the spiders."""
+
+    def __init__(self):
+        """Create an empty collector."""
+        self.library_names = {}
+        self.library_metadata = {}
+        self._lock = threading.Lock()
 
-    def __init__(self, output_path):
-        """Create the item pipeline."""
-        self.output_path = output_path
+    def add(self, lang: str, library_name: str, library_metadata: Iterable[str]):
+        """Add a library along with its metadata."""
+        with self._lock:
+            self.library_names.setdefault(lang, set()).add(library_name)
+            metadata = self.library_metadata.setdefault(lang, {})
+            for meta in library_metadata:
+                metadata.setdefault(meta, set()).add(library_name)
 
-    @classmethod
-    def from_crawler(cls, crawler):
-        """Pass the output path to the constructor when instantiating from the crawler."""
-        return cls(output_path=crawler.settings["OUTPUT_PATH"])
+    def merge(
+        self,
+        library_names: Dict[str, Set[str]],
+        library_metadata: Dict[str, Dict[str, Set[str]]],
+    ):
+        """Merge the libraries collected by another collector, e.g. in another process."""
+        with self._lock:
+            for lang, names in library_names.items():
+                self.library_names.setdefault(lang, set()).update(names)
+                self.library_metadata.setdefault(lang, {})
+            for lang, metadata in library_metadata.items():
+                lang_metadata = self.library_metadata.setdefault(lang, {})
+                for meta, libs in metadata.items():
+                    lang_metadata.setdefault(meta, set()).update(libs)
+
+    def save(self, output_path: Path, log_level: int = logging.INFO):
+        """
+        Save the libraries as a StandardLibraries model.
+
+        The model is written to a temporary file next to the output path which is then renamed,
+        so that it is never left partially written.
+        """
+        fd, tmp_path = tempfile.mkstemp(
+            suffix=output_path.suffix,
+            prefix=".%s." % output_path.stem,
+            dir=str(output_path.parent),
+        )
+        os.close(fd)
+        try:
+            with self._lock:
+                StandardLibraries(log_level=log_level).construct(
+                    self.library_names, self.library_metadata
+                ).save(tmp_path, series="stdlib")
+            os.replace(tmp_path, str(output_path))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+
+class StdlibPipeline(object):
+    """Item pipeline that passes the items to the collector of the spider which found them."""
 
     def open_spider(self, spider):
         """Open a spider."""
-        type(self).pending_spiders += 1
-        log = logging.getLogger(spider.name)
-        log.info("Opened spider, pending: %d", self.pending_spiders)
+        logging.getLogger(spider.name).info("Opened spider")
 
     def close_spider(self, spider):
-        """Close a spider, and save the model if it is the last to terminate."""
-        log = logging.getLogger(spider.name)
-        type(self).pending_spiders -= 1
-        log.info("Closed spider, pending: %d", self.pending_spiders)
-        if self.pending_spiders == 0:
-            log.info("No more spiders are running, creating the model ...")
-            StandardLibraries(log_level=logging.INFO).construct(
-                self.library_names, self.library_metadata
-            ).save(self.output_path, series="stdlib")
-            log.info("Saved model to %s", self.output_path)
+        """Close a spider."""
+        logging.getLogger(spider.name).info("Closed spider")
 
     def process_item(self, item, spider):
         """Process an item returned by one of the spiders."""
-        lang, library_name = item["lang"], item["library_name"]
-        if lang not in self.library_names:
-            self.library_names[lang] = set()
-            self.library_metadata[lang] = {}
-        self.library_names[lang].add(library_name)
-        for meta in item["library_metadata"]:
-            if meta not in self.library_metadata[lang]:
-                self.library_metadata[lang][meta] = set()
-            self.library_metadata[lang][meta].add(library_name)
+        spider.collector.add(item["lang"], item["library_name"], item["library_metadata"])
+        return item
+
+
+def crawler_settings(
+    cache_dir: Optional[Path] = None,
+    offline: bool = False,
+    concurrency: int = DEFAULT_CONCURRENCY,
+) -> dict:
+    """
+    Create the settings of the crawler process.
+
+    Responses are stored in cache_dir if it is given. They are revalidated with conditional
+    requests following RFC 2616, or replayed without network access at all if offline is True,
+    in which case requests missing from the cache are ignored.
+    """
+    settings = {
+        "BOT_NAME": "vegeta",
+        "ITEM_PIPELINES": {"sourced.ml.mining.cmd.collect_stdlibs.StdlibPipeline": 100},
+        "LOG_ENABLED": 0,
+        "CONCURRENT_REQUESTS": concurrency,
+        "CONCURRENT_REQUESTS_PER_DOMAIN": concurrency,
+        "DOWNLOAD_TIMEOUT": 60,
+        "COOKIES_ENABLED": False,
+        "TELNETCONSOLE_ENABLED": False,
+    }
+    if cache_dir is not None:
+        settings.update(
+            {
+                "HTTPCACHE_ENABLED": True,
+                "HTTPCACHE_DIR": str(cache_dir.absolute()),
+                "HTTPCACHE_GZIP": True,
+                "HTTPCACHE_ALWAYS_STORE": True,
+                "HTTPCACHE_IGNORE_HTTP_CODES": [500, 502, 503, 504, 522, 524, 408, 429],
+                "HTTPCACHE_POLICY": "scrapy.extensions.httpcache.%s"
+                % ("DummyPolicy" if offline else "RFC2616Policy"),
+                "HTTPCACHE_IGNORE_MISSING": offline,
+            }
+        )
+    return settings
+
+
+def crawl_stdlibs(
+    spiders: List[type], settings: dict
+) -> Tuple[Dict[str, Set[str]], Dict[str, Dict[str, Set[str]]]]:
+    """
+    Run the spiders in a crawler process and return the libraries they collected.
+
+    The Twisted reactor cannot be restarted, so this must run at most once per process.
+    """
+    collector = StdlibCollector()
+    process = CrawlerProcess(settings=settings)
+    logging.getLogger("scrapy").setLevel(logging.WARNING)
+    for spider in spiders:
+        process.crawl(spider, collector=collector)
+    process.start()
+    process.stop()
+    return collector.library_names, collector.library_metadata
 
 
 def collect_stdlibs(args: argparse.Namespace):
@@ -67,28 +166,22 @@ def collect_stdlibs(args: argparse.Namespace):
     Collect the lists of standard library_names for each language Babelfish can parse.
     """
     log = logging.getLogger("collect_stdlibs")
+    if args.offline and args.cache_dir is None:
+        log.error("Offline replay requires a --cache-dir, aborting")
+        raise ValueError
     output_path = path_with_suffix(args.output_path, ".asdf")
     check_remove_filepath(output_path, log, args.force)
-    process = CrawlerProcess(
-        settings={
-            "BOT_NAME": "vegeta",
-            "ITEM_PIPELINES": {
-                "sourced.ml.mining.cmd.collect_stdlibs.StdlibPipeline": 100
-            },
-            "LOG_ENABLED": 0,
-            "OUTPUT_PATH": output_path,
-        }
-    )
-    logging.getLogger("scrapy").setLevel(logging.WARNING)
-
-    for spider in [
-        CppStdlibSpider,
-        CSharpStdlibSpider,
-        GoStdlibSpider,
-        JavaStdlibSpider,
-        PythonStdlibSpider,
-        RubyStdlibSpider,
-    ]:
-        process.crawl(spider)
-    process.start()
-    process.stop()
+    settings = crawler_settings(args.cache_dir, args.offline, args.concurrency)
+    collector = StdlibCollector()
+    workers = min(args.workers, len(SPIDERS))
+    if workers <= 1:
+        collector.merge(*crawl_stdlibs(SPIDERS, settings))
+    else:
+        # Each crawl runs in a fresh process, since a process can only start one reactor
+        shards = [(SPIDERS[worker::workers], settings) for worker in range(workers)]
+        with multiprocessing.get_context("spawn").Pool(workers, maxtasksperchild=1) as pool:
+            for partial in pool.starmap(crawl_stdlibs, shards, chunksize=1):
+                collector.merge(*partial)
+    log.info("No more spiders are running, creating the model ...")
+    collector.save(output_path, log_level=args.log_level)
+    log.info("Saved model to %s", output_path)
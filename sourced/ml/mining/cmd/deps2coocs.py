@@ -0,0 +1,95 @@
+import argparse
+import logging
+
+from sourced.ml.core.models import Cooccurrences
+
+from sourced.ml.mining.models import Dependencies
+from sourced.ml.mining.utils import (
+    check_empty_directory,
+    check_remove_filepath,
+    create_swivel_inputs,
+    create_swivel_inputs_from_chunks,
+    dep_tokens,
+    deps_coocs_matrix,
+    get_metrics,
+    instrumented,
+    iter_coocs_chunks,
+    path_with_suffix,
+    select_deps,
+)
+
+
+@instrumented
+def deps2coocs(args: argparse.Namespace):
+    """
+    Compute the co-occurrence matrix between dependencies from a dependencies model.
+    """
+    log = logging.getLogger("deps2coocs")
+    metrics = get_metrics()
+    if args.swivel:
+        output_path = args.output_path
+        check_empty_directory(output_path, log, args.force, False)
+        output_path.mkdir(parents=True, exist_ok=True)
+        if args.spill_dir is not None:
+            args.spill_dir.mkdir(parents=True, exist_ok=True)
+    else:
+        output_path = path_with_suffix(args.output_path, ".asdf")
+        check_remove_filepath(output_path, log, args.force)
+    log.info("Loading the dependencies model ...")
+    with metrics.stage("load") as stage:
+        model = Dependencies(log_level=args.log_level).load(str(args.input_path))
+        cols = select_deps(model, args.langs, args.min_files)
+        stage.set(deps=len(model.deps), selected_deps=len(cols))
+    log.info(
+        "Selected %d dependencies out of %d imported by at least %d files",
+        len(cols),
+        len(model.deps),
+        args.min_files,
+    )
+    tokens = dep_tokens(model, cols)
+    files_matrix = model.csc[:, cols]
+    if args.swivel and args.spill_dir is not None:
+        # The co-occurrences are computed block by block in each pass over the chunks, so that
+        # the whole matrix is never held in memory
+        log.info("Creating the Swivel inputs ...")
+        create_swivel_inputs_from_chunks(
+            output_path,
+            log,
+            lambda: iter_coocs_chunks(
+                files_matrix,
+                block_size=args.block_size,
+                min_coocs=args.min_coocs,
+                workers=args.workers,
+            ),
+            (len(cols), len(cols)),
+            args.shard_size,
+            tokens,
+            workers=args.workers,
+            spill_dir=args.spill_dir,
+        )
+        log.info("Saved Swivel inputs to %s", output_path)
+        return
+    with metrics.stage("coocs") as stage:
+        matrix = deps_coocs_matrix(
+            files_matrix,
+            log,
+            block_size=args.block_size,
+            min_coocs=args.min_coocs,
+            workers=args.workers,
+        )
+        stage.set(nnz=matrix.nnz)
+    log.info("Computed %d non-zero co-occurrences", matrix.nnz)
+    if args.swivel:
+        log.info("Creating the Swivel inputs ...")
+        create_swivel_inputs(
+            output_path, log, matrix, args.shard_size, tokens, workers=args.workers
+        )
+        log.info("Saved Swivel inputs to %s", output_path)
+    else:
+        log.info("Creating the co-occurrences model ...")
+        with metrics.stage("save") as stage:
+            Cooccurrences(log_level=args.log_level).construct(tokens, matrix).save(
+                str(output_path), series="coocc"
+            )
+            stage.set(bytes=output_path.stat().st_size)
+        log.info("Saved model to %s", output_path)
@@ -0,0 +1,39 @@
+import argparse
+import logging
+
+from sourced.ml.mining.models import Dependencies, StandardLibraries
+from sourced.ml.mining.utils import (
+    check_remove_filepath,
+    filter_stdlib_dependencies,
+    path_with_suffix,
+)
+
+
+def filter_stdlibs(args: argparse.Namespace):
+    """
+    Remove or annotate the standard library dependencies of a dependencies model.
+    """
+    log = logging.getLogger("filter_stdlibs")
+    output_path = path_with_suffix(args.output_path, ".asdf")
+    check_remove_filepath(output_path, log, args.force)
+    log.info("Loading the models ...")
+    model = Dependencies(log_level=args.log_level).load(str(args.input_path), lazy=True)
+    stdlibs = StandardLibraries(log_level=args.log_level).load(str(args.stdlib_path))
+    log.info("Classifying %d dependencies ...", len(model.deps))
+    result = filter_stdlib_dependencies(
+        model,
+        stdlibs,
+        annotate=args.annotate,
+        prefixes=not args.exact,
+        log_level=args.log_level,
+    )
+    if args.annotate:
+        log.info(
+            "Annotated %d standard library dependencies", result.stdlib_mask.sum()
+        )
+    else:
+        log.info(
+            "Removed %d standard library dependencies", len(model.deps) - len(result.deps)
+        )
+    result.save(str(output_path), series="deps", compress=not args.uncompressed)
+    log.info("Saved model to %s", output_path)
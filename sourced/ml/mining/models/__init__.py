@@ -1,3 +1,3 @@
 # flake8: noqa
-from sourced.ml.mining.models.dependencies import Dependencies
-from sourced.ml.mining.models.stdlib import StandardLibraries
+from sourced.ml.mining.models.dependencies import CategoricalMapping, Dependencies
+from sourced.ml.mining.models.stdlib import StandardLibraries, StdlibIndex
@@ -1,13 +1,273 @@
+from concurrent.futures import ThreadPoolExecutor
+import functools
+from typing import Callable, Hashable, Iterable, List, Mapping, Sequence, Union
+import zlib
+
 from modelforge import (
     assemble_sparse_matrix,
-    disassemble_sparse_matrix,
     merge_strings,
     Model,
     register_model,
     split_strings,
+    squeeze_bits,
 )
+import numpy as np
+from scipy.sparse import csr_matrix, spmatrix
 from sourced.ml.core.models.license import DEFAULT_LICENSE
 
+PACK_CHUNK_SIZE = 1 << 22
+PACK_COMPRESSION_LEVEL = 1
+
+
+class LazyStrings(Sequence):
+    """
+    Read-only sequence of strings which are only decoded when accessed, backed by the array of
+    their concatenated UTF-8 bytes (typically memory-mapped) and the array of their lengths in
+    bytes.
+    """
+
+    def __init__(self, data: np.ndarray, lengths: np.ndarray):
+        self._data = data
+        self._lengths = lengths
+        self._offsets = None
+
+    def __getitem__(self, ind):
+        if isinstance(ind, slice):
+            return [self[i] for i in range(*ind.indices(len(self)))]
+        if ind < 0:
+            ind += len(self)
+        if not 0 <= ind < len(self):
+            raise IndexError(ind)
+        if self._offsets is None:
+            self._offsets = np.zeros(len(self._lengths) + 1, dtype=np.int64)
+            np.cumsum(self._lengths, out=self._offsets[1:])
+        start, end = self._offsets[ind], self._offsets[ind + 1]
+        return self._data[start:end].tobytes().decode("utf-8")
+
+    def __len__(self):
+        return len(self._lengths)
+
+
+def merge_utf8_strings(strings: Iterable[str]) -> dict:
+    """Pack strings like merge_strings() does, with the lengths counted in bytes so that each
+    string can be decoded independently. LazyStrings are packed as is, without being decoded."""
+    if isinstance(strings, LazyStrings) and len(strings._data):
+        return {
+            "strings": np.ascontiguousarray(strings._data).view("S%d" % len(strings._data)),
+            "lengths": squeeze_bits(np.asarray(strings._lengths, dtype=int)),
+            "str": False,
+        }
+    return merge_strings([string.encode("utf-8") for string in strings])
+
+
+def split_utf8_strings(subtree: dict, lazy: bool = False, threads: int = 1) -> Sequence[str]:
+    """Unpack the strings packed by pack_utf8_strings(), merge_utf8_strings() or
+    merge_strings()."""
+    if "blob" in subtree:
+        return unpack_utf8_strings(subtree, lazy, threads)
+    if subtree.get("str", True):
+        return split_strings(subtree)
+    if lazy:
+        return LazyStrings(
+            np.asarray(subtree["strings"]).view(np.uint8), np.asarray(subtree["lengths"])
+        )
+    return [string.decode("utf-8") for string in split_strings(subtree)]
+
+
+def _map_threads(func: Callable, items: Sequence, threads: int) -> List:
+    if threads <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(threads, len(items))) as executor:
+        return list(executor.map(func, items))
+
+
+def pack_array(arr: np.ndarray, threads: int = 1, chunk_size: int = PACK_CHUNK_SIZE) -> dict:
+    """Compress a one-dimensional array with zlib by chunks of bytes. zlib releases the GIL, so
+    the chunks are compressed in parallel by the given number of threads."""
+    arr = np.ascontiguousarray(arr)
+    buffer = arr.view(np.uint8)
+    compressed = _map_threads(
+        functools.partial(zlib.compress, level=PACK_COMPRESSION_LEVEL),
+        [buffer[start:start + chunk_size] for start in range(0, len(buffer), chunk_size)],
+        threads,
+    )
+    return {
+        "dtype": arr.dtype.str,
+        "size": len(arr),
+        "chunk_size": chunk_size,
+        "chunks": np.array([len(chunk) for chunk in compressed], dtype=np.int64),
+        "data": np.frombuffer(b"".join(compressed), dtype=np.uint8),
+    }
+
+
+def unpack_array(subtree: dict, threads: int = 1) -> np.ndarray:
+    """Decompress an array packed by pack_array(), with the chunks decompressed in parallel."""
+    arr = np.empty(subtree["size"], dtype=np.dtype(subtree["dtype"]))
+    buffer = arr.view(np.uint8)
+    data = np.asarray(subtree["data"])
+    bounds = np.zeros(len(subtree["chunks"]) + 1, dtype=np.int64)
+    np.cumsum(subtree["chunks"], out=bounds[1:])
+    chunk_size = subtree["chunk_size"]
+
+    def decompress(ind):
+        chunk = zlib.decompress(data[bounds[ind]:bounds[ind + 1]])
+        buffer[ind * chunk_size:ind * chunk_size + len(chunk)] = np.frombuffer(chunk, np.uint8)
+
+    _map_threads(decompress, range(len(bounds) - 1), threads)
+    return arr
+
+
+def load_array(value: Union[np.ndarray, dict], threads: int = 1) -> np.ndarray:
+    """Return an array of the tree, which is decompressed if it was packed by pack_array()."""
+    if isinstance(value, dict):
+        return unpack_array(value, threads)
+    return np.asarray(value)
+
+
+def pack_csr_pattern(matrix: spmatrix, threads: int = 1) -> dict:
+    """Pack the positions of the non-zero entries of a sparse matrix, without their values: the
+    number of entries of each row, and the gaps between the sorted column indices of each row,
+    which are small and compress well. Both are stored with the narrowest integer type."""
+    csr = matrix.tocsr()
+    if csr.nnz and not csr.data.all():
+        csr = csr.copy()
+        csr.eliminate_zeros()
+    if not csr.has_canonical_format:
+        csr = csr.copy()
+        csr.sum_duplicates()
+    lengths = np.diff(csr.indptr)
+    indices = csr.indices.astype(np.int64)
+    deltas = np.empty_like(indices)
+    if len(indices):
+        deltas[0] = indices[0]
+        np.subtract(indices[1:], indices[:-1], out=deltas[1:])
+    # The first index of each row is stored as is
+    starts = csr.indptr[:-1][lengths > 0]
+    deltas[starts] = indices[starts]
+    return {
+        "shape": csr.shape,
+        "format": "csr_pattern",
+        "lengths": pack_array(squeeze_bits(lengths), threads),
+        "deltas": pack_array(squeeze_bits(deltas), threads),
+    }
+
+
+def unpack_csr_pattern(subtree: dict, threads: int = 1) -> csr_matrix:
+    """Rebuild the boolean CSR matrix packed by pack_csr_pattern()."""
+    shape = tuple(subtree["shape"])
+    lengths = unpack_array(subtree["lengths"], threads)
+    indptr = np.zeros(shape[0] + 1, dtype=np.int64)
+    np.cumsum(lengths, out=indptr[1:])
+    deltas = unpack_array(subtree["deltas"], threads)
+    indices = np.cumsum(deltas, dtype=np.int64)
+    # Rebase the indices of each row, which are summed with the deltas of the previous rows
+    starts = indptr[:-1][lengths > 0]
+    rebase = np.zeros(shape[0], dtype=np.int64)
+    rebase[lengths > 0] = indices[starts] - deltas[starts]
+    indices -= np.repeat(rebase, lengths)
+    index_dtype = np.int32 if max(shape[1], len(indices)) < np.iinfo(np.int32).max else np.int64
+    return csr_matrix(
+        (
+            np.ones(len(indices), dtype=bool),
+            indices.astype(index_dtype),
+            indptr.astype(index_dtype),
+        ),
+        shape=shape,
+    )
+
+
+def pack_utf8_strings(strings: Iterable[str], threads: int = 1) -> dict:
+    """Pack strings as the compressed blob of their UTF-8 bytes and the compressed array of
+    their lengths in bytes. LazyStrings are packed without being decoded."""
+    if isinstance(strings, LazyStrings):
+        blob, lengths = np.asarray(strings._data), np.asarray(strings._lengths)
+    else:
+        encoded = [string.encode("utf-8") for string in strings]
+        blob = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+        lengths = np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded))
+        del encoded
+    return {
+        "blob": pack_array(blob, threads),
+        "lengths": pack_array(squeeze_bits(lengths.astype(np.int64)), threads),
+    }
+
+
+def unpack_utf8_strings(subtree: dict, lazy: bool = False, threads: int = 1) -> Sequence[str]:
+    """Unpack the strings packed by pack_utf8_strings(), which are only decoded when accessed
+    if lazy is True."""
+    blob = unpack_array(subtree["blob"], threads)
+    lengths = unpack_array(subtree["lengths"], threads)
+    if lazy:
+        return LazyStrings(blob, lengths)
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    data = blob.tobytes()
+    del blob
+    return [
+        data[start:end].decode("utf-8")
+        for start, end in zip(offsets[:-1].tolist(), offsets[1:].tolist())
+    ]
+
+
+class CategoricalMapping(Mapping):
+    """
+    Read-only mapping from file index to a category, e.g. the language or the repository,
+    backed by an array of category codes and the list of categories.
+    """
+
+    def __init__(self, categories: List[str], codes: np.ndarray):
+        self._categories = categories
+        self._codes = codes
+        self._category_index = None
+        self._order = None
+        self._bounds = None
+
+    @classmethod
+    def from_values(cls, values: Iterable[Hashable]) -> "CategoricalMapping":
+        index = {}
+        codes = np.fromiter(
+            (index.setdefault(value, len(index)) for value in values), dtype=np.int64
+        )
+        return cls(list(index), codes.astype(np.min_scalar_type(max(len(index) - 1, 0))))
+
+    @property
+    def categories(self) -> List[str]:
+        return self._categories
+
+    @property
+    def codes(self) -> np.ndarray:
+        return self._codes
+
+    def code(self, category: str) -> int:
+        """Return the code of a category, raise KeyError if it is unknown."""
+        if self._category_index is None:
+            self._category_index = {
+                category: code for code, category in enumerate(self._categories)
+            }
+        return self._category_index[category]
+
+    def indices(self, category: str) -> np.ndarray:
+        """Return the sorted indices mapped to a category, using the indices grouped by code
+        which are computed on the first call."""
+        code = self.code(category)
+        if self._order is None:
+            self._order = np.argsort(self._codes, kind="stable")
+            self._bounds = np.searchsorted(
+                self._codes[self._order], np.arange(len(self._categories) + 1)
+            )
+        return self._order[self._bounds[code]:self._bounds[code + 1]]
+
+    def __getitem__(self, ind):
+        if not 0 <= ind < len(self._codes):
+            raise KeyError(ind)
+        return self._categories[self._codes[ind]]
+
+    def __iter__(self):
+        return iter(range(len(self._codes)))
+
+    def __len__(self):
+        return len(self._codes)
+
 
 @register_model
 class Dependencies(Model):
@@ -23,47 +283,144 @@ class Dependencies(Model):
     )
     LICENSE = DEFAULT_LICENSE
 
-    def construct(self, matrix, files, deps, ind_to_langs, ind_to_repos):
+    _lazy = False
+    _compress = True
+    _threads = 1
+
+    def construct(self, matrix, files, deps, ind_to_langs, ind_to_repos, stdlib_mask=None):
         self._matrix = matrix
         self._files = files
         self._deps = deps
-        self._ind_to_langs = ind_to_langs
-        self._ind_to_repos = ind_to_repos
+        self._ind_to_langs = self._to_categorical(ind_to_langs, len(files))
+        self._ind_to_repos = self._to_categorical(ind_to_repos, len(files))
+        self._stdlib_mask = stdlib_mask
+        self._csr = None
+        self._csc = None
+        self._dep_langs = None
+        self._file_index = None
+        self._dep_index = None
+        self._top_deps = {}
         return self
 
+    @staticmethod
+    def _to_categorical(mapping, size):
+        if isinstance(mapping, CategoricalMapping):
+            return mapping
+        return CategoricalMapping.from_values(mapping[ind] for ind in range(size))
+
+    def load(self, source=None, cache_dir=None, backend=None, lazy=False, threads=1):
+        """
+        Load the model. When lazy is True, the arrays are memory-mapped instead of being read,
+        and the files and dependencies are only decoded when accessed, so that several processes
+        share the same model through the page cache. Only the arrays of models saved with
+        compress=False can be memory-mapped, the others are decompressed in memory by the given
+        number of threads.
+        """
+        self._lazy = lazy
+        self._threads = threads
+        try:
+            return super().load(source=source, cache_dir=cache_dir, backend=backend, lazy=lazy)
+        finally:
+            self._threads = 1
+
+    def save(
+        self,
+        output,
+        series=None,
+        deps=tuple(),
+        create_missing_dirs=True,
+        compress=True,
+        threads=1,
+    ):
+        """
+        Save the model. When compress is True, only the positions of the non-zero entries of
+        the matrix are stored, as delta-encoded indices, and the arrays are compressed by the
+        given number of threads. Otherwise, the arrays are written uncompressed and the matrix
+        in CSR format with full-width indices, so that they can be memory-mapped.
+        """
+        self._compress = compress
+        self._threads = threads
+        # The arrays of compressed models are already packed, ASDF must not compress them again
+        self.ARRAY_COMPRESSION = None
+        try:
+            return super().save(
+                output, series=series, deps=deps, create_missing_dirs=create_missing_dirs
+            )
+        finally:
+            self._compress = True
+            self._threads = 1
+            self.__dict__.pop("ARRAY_COMPRESSION", None)
+
+    def _load_matrix(self, subtree):
+        if subtree["format"] == "csr_pattern":
+            return unpack_csr_pattern(subtree, self._threads)
+        if self._lazy and subtree["format"] == "csr":
+            data, indices, indptr = (np.asarray(arr) for arr in subtree["data"])
+            if indptr[-1] == data.shape[0] and indices.dtype in (np.int32, np.int64):
+                return csr_matrix((data, indices, indptr), shape=subtree["shape"], copy=False)
+        return assemble_sparse_matrix(subtree)
+
     def _load_tree(self, tree):
-        matrix = assemble_sparse_matrix(tree["matrix"])
-        files = split_strings(tree["files"])
-        deps = split_strings(tree["deps"])
-        ind_to_langs = {
-            ind: lang for ind, lang in enumerate(split_strings(tree["ind_to_langs"]))
-        }
-        ind_to_repos = {
-            ind: repo for ind, repo in enumerate(split_strings(tree["ind_to_repos"]))
-        }
-        self.construct(matrix, files, deps, ind_to_langs, ind_to_repos)
+        matrix = self._load_matrix(tree["matrix"])
+        files = split_utf8_strings(tree["files"], self._lazy, self._threads)
+        deps = split_utf8_strings(tree["deps"], self._lazy, self._threads)
+        if "lang_codes" in tree:
+            ind_to_langs = CategoricalMapping(
+                split_strings(tree["langs"]), load_array(tree["lang_codes"], self._threads)
+            )
+            ind_to_repos = CategoricalMapping(
+                split_strings(tree["repos"]), load_array(tree["repo_codes"], self._threads)
+            )
+        else:
+            # Models saved before the categorical encoding store one string per file
+            ind_to_langs = CategoricalMapping.from_values(split_strings(tree["ind_to_langs"]))
+            ind_to_repos = CategoricalMapping.from_values(split_strings(tree["ind_to_repos"]))
+        stdlib_mask = (
+            load_array(tree["stdlib_mask"], self._threads) if "stdlib_mask" in tree else None
+        )
+        self.construct(matrix, files, deps, ind_to_langs, ind_to_repos, stdlib_mask)
 
     def _generate_tree(self):
-        return {
-            "matrix": disassemble_sparse_matrix(self._matrix),
-            "files": merge_strings(self._files),
-            "deps": merge_strings(self._deps),
-            "ind_to_langs": merge_strings(
-                [self._ind_to_langs[ind] for ind in range(len(self._files))]
-            ),
-            "ind_to_repos": merge_strings(
-                [self._ind_to_repos[ind] for ind in range(len(self._files))]
-            ),
-        }
+        if self._compress:
+            threads = self._threads
+            tree = {
+                "matrix": pack_csr_pattern(self._matrix, threads),
+                "files": pack_utf8_strings(self._files, threads),
+                "deps": pack_utf8_strings(self._deps, threads),
+                "lang_codes": pack_array(self._ind_to_langs.codes, threads),
+                "repo_codes": pack_array(self._ind_to_repos.codes, threads),
+            }
+            if self._stdlib_mask is not None:
+                tree["stdlib_mask"] = pack_array(self._stdlib_mask, threads)
+        else:
+            csr = self._matrix.tocsr()
+            tree = {
+                "matrix": {
+                    "shape": csr.shape,
+                    "format": "csr",
+                    "data": [csr.data, csr.indices, csr.indptr],
+                },
+                "files": merge_utf8_strings(self._files),
+                "deps": merge_utf8_strings(self._deps),
+                "lang_codes": self._ind_to_langs.codes,
+                "repo_codes": self._ind_to_repos.codes,
+            }
+            if self._stdlib_mask is not None:
+                tree["stdlib_mask"] = self._stdlib_mask
+        tree["langs"] = merge_strings(self._ind_to_langs.categories)
+        tree["repos"] = merge_strings(self._ind_to_repos.categories)
+        return tree
 
     def dump(self):
-        msg = "Number of repos: %d\n" % len(set(self._ind_to_repos.values()))
+        msg = "Number of repos: %d\n" % len(np.unique(self._ind_to_repos.codes))
         msg += "Number of files: %d\n" % len(self._files)
         msg += "Number of distinct dependencies: %d\n" % len(self._deps)
         msg += (
             "Number of non-zero entries in the file-dependencies co-occurence matrix: %d\n"
             % self._matrix.getnnz()
         )
+        if self._stdlib_mask is not None:
+            msg += "Number of standard library dependencies: %d\n" % self._stdlib_mask.sum()
         return msg
 
     @property
@@ -90,13 +447,132 @@ class Dependencies(Model):
     @property
     def inds_to_lang(self):
         """
-        Returns the mapping from file index to language.
+        Returns the mapping from file index to language, backed by an array of language codes.
         """
         return self._ind_to_langs
 
     @property
     def inds_to_repo(self):
         """
-        Returns the mapping from file index to repo.
+        Returns the mapping from file index to repo, backed by an array of repo codes.
         """
         return self._ind_to_repos
+
+    @property
+    def stdlib_mask(self):
+        """
+        Returns the mask of the dependencies which belong to the standard library of their
+        language, None if the model was not annotated.
+        """
+        return self._stdlib_mask
+
+    @property
+    def csr(self):
+        """
+        Returns the co-occurrence matrix in CSR format, to access the dependencies of files.
+        """
+        if self._csr is None:
+            self._csr = self._matrix.tocsr()
+        return self._csr
+
+    @property
+    def csc(self):
+        """
+        Returns the co-occurrence matrix in CSC format, to access the files of dependencies.
+        """
+        if self._csc is None:
+            self._csc = self._matrix.tocsc()
+        return self._csc
+
+    @property
+    def dep_langs(self):
+        """
+        Returns the mapping from dependency index to language, which is the language of any of
+        the files importing it. Dependencies without files are mapped to an empty string.
+        """
+        if self._dep_langs is None:
+            csc = self.csc
+            has_files = csc.indptr[1:] > csc.indptr[:-1]
+            langs = list(self._ind_to_langs.categories)
+            codes = np.full(len(self._deps), len(langs), dtype=np.int64)
+            codes[has_files] = self._ind_to_langs.codes[csc.indices[csc.indptr[:-1][has_files]]]
+            if not has_files.all():
+                langs.append("")
+            self._dep_langs = CategoricalMapping(
+                langs, codes.astype(np.min_scalar_type(max(len(langs) - 1, 0)))
+            )
+        return self._dep_langs
+
+    def file_index(self, lang, repo, file):
+        """
+        Returns the index of a file, raises KeyError if it is unknown. The lookup table is
+        built on the first call.
+        """
+        if self._file_index is None:
+            langs, repos = self._ind_to_langs.categories, self._ind_to_repos.categories
+            self._file_index = {
+                (langs[lang_code], repos[repo_code], file): ind
+                for ind, (lang_code, repo_code, file) in enumerate(
+                    zip(
+                        self._ind_to_langs.codes.tolist(),
+                        self._ind_to_repos.codes.tolist(),
+                        self._files,
+                    )
+                )
+            }
+        return self._file_index[(lang, repo, file)]
+
+    def dep_index(self, lang, dep):
+        """
+        Returns the index of a dependency, raises KeyError if it is unknown. The lookup table
+        is built on the first call.
+        """
+        if self._dep_index is None:
+            langs = self.dep_langs.categories
+            self._dep_index = {
+                (langs[lang_code], dep): ind
+                for ind, (lang_code, dep) in enumerate(
+                    zip(self.dep_langs.codes.tolist(), self._deps)
+                )
+            }
+        return self._dep_index[(lang, dep)]
+
+    def deps_of_file(self, ind):
+        """
+        Returns the indices of the dependencies imported by a file.
+        """
+        csr = self.csr
+        return csr.indices[csr.indptr[ind]:csr.indptr[ind + 1]]
+
+    def files_of_dep(self, ind):
+        """
+        Returns the indices of the files importing a dependency.
+        """
+        csc = self.csc
+        return csc.indices[csc.indptr[ind]:csc.indptr[ind + 1]]
+
+    def files_of_repo(self, repo):
+        """
+        Returns the indices of the files of a repo.
+        """
+        return self._ind_to_repos.indices(repo)
+
+    def files_of_lang(self, lang):
+        """
+        Returns the indices of the files of a language.
+        """
+        return self._ind_to_langs.indices(lang)
+
+    def top_deps(self, lang, k=10):
+        """
+        Returns the indices of the k dependencies of a language imported by the most files,
+        along with their number of files. The ranking of each language is computed on its first
+        call.
+        """
+        if lang not in self._top_deps:
+            inds = self.dep_langs.indices(lang)
+            counts = np.diff(self.csc.indptr)[inds]
+            order = np.argsort(-counts, kind="stable")
+            self._top_deps[lang] = inds[order], counts[order]
+        inds, counts = self._top_deps[lang]
+        return inds[:k], counts[:k]
@@ -1,6 +1,86 @@
+import re
+from typing import Dict, Iterable, List, Set
+
 from modelforge import merge_strings, Model, register_model, split_strings
+import numpy as np
 from sourced.ml.core.models.license import DEFAULT_LICENSE
 
+SEPARATORS = re.compile(r"(\.|/|::)")
+
+
+class StdlibIndex:
+    """
+    Lookup index of the standard library of a language: a hash table of the library names, a
+    trie of their components split on dots, slashes and double colons to match the names
+    which have a library as prefix, and the reverse mapping from library to metadata.
+    """
+
+    def __init__(self, library_names: Set[str], library_metadata: Dict[str, Set[str]]):
+        libraries = set(library_names)
+        for libs in library_metadata.values():
+            libraries.update(libs)
+        self._libraries = sorted(libraries)
+        self._ids = {library: ind for ind, library in enumerate(self._libraries)}
+        self._metadata = [[] for _ in self._libraries]
+        for meta, libs in library_metadata.items():
+            for library in libs:
+                self._metadata[self._ids[library]].append(meta)
+        # Each node maps the next component or separator to its child, and None to the id of
+        # the library ending at that node if any
+        self._trie = {}
+        for library in self._libraries:
+            node = self._trie
+            for token in SEPARATORS.split(library):
+                node = node.setdefault(token, {})
+            node[None] = self._ids[library]
+
+    @property
+    def libraries(self) -> List[str]:
+        return self._libraries
+
+    def find(self, name: str, prefixes: bool = True) -> int:
+        """
+        Return the id of the library matching a name, -1 if there is none. If prefixes is True,
+        the name also matches the longest library which is a prefix of it up to a separator,
+        e.g. "os.path.join" matches "os.path".
+        """
+        ind = self._ids.get(name, -1)
+        if ind >= 0 or not prefixes:
+            return ind
+        node = self._trie
+        for token in SEPARATORS.split(name):
+            node = node.get(token)
+            if node is None:
+                break
+            ind = node.get(None, ind)
+        return ind
+
+    def match(self, names: Iterable[str], prefixes: bool = True) -> np.ndarray:
+        """
+        Return the ids of the libraries matching each name as found by find(), -1 for the
+        names which do not match.
+        """
+        return np.fromiter((self.find(name, prefixes) for name in names), dtype=np.int64)
+
+    def library(self, ind: int) -> str:
+        return self._libraries[ind]
+
+    def metadata(self, library: str) -> List[str]:
+        """
+        Return the metadata categories of a library, empty if it is unknown.
+        """
+        ind = self._ids.get(library)
+        return [] if ind is None else list(self._metadata[ind])
+
+    def metadata_mask(self, meta: str, inds: np.ndarray) -> np.ndarray:
+        """
+        Return the mask of the library ids, as returned by match(), which belong to a metadata
+        category.
+        """
+        libs = np.zeros(len(self._libraries) + 1, dtype=bool)
+        libs[[ind for ind, metas in enumerate(self._metadata) if meta in metas]] = True
+        return libs[inds]
+
 
 @register_model
 class StandardLibraries(Model):
@@ -21,6 +101,7 @@ class StandardLibraries(Model):
         self._library_names = library_names
         self._library_metadata = library_metadata
         self._langs = [l for l in sorted(library_names)]
+        self._indexes = {}
         return self
 
     def _load_tree(self, tree):
@@ -60,8 +141,22 @@ class StandardLibraries(Model):
         return self._library_metadata.get(lang, {})
 
     def get_library(self, lang, library):
-        return [
-            meta
-            for meta, libs in self.get_library_metadata(lang).items()
-            if library in libs
-        ]
+        return self.index(lang).metadata(library)
+
+    def index(self, lang):
+        """
+        Returns the lookup index of the standard library of a language, which is built on the
+        first call.
+        """
+        if lang not in self._indexes:
+            self._indexes[lang] = StdlibIndex(
+                self.get_library_names(lang), self.get_library_metadata(lang)
+            )
+        return self._indexes[lang]
+
+    def classify(self, lang, names, prefixes=True):
+        """
+        Returns the mask of the names which belong to the standard library of a language, either
+        exactly or, if prefixes is True, through any of their prefixes.
+        """
+        return self.index(lang).match(names, prefixes) >= 0
@@ -2,6 +2,8 @@ import zlib
 
 import scrapy
 
+INVENTORY_HEADER = b"# Sphinx inventory version "
+
 
 class PythonStdlibSpider(scrapy.Spider):
     """Spider for scraping the Python standard libraries."""
@@ -11,41 +13,40 @@ class PythonStdlibSpider(scrapy.Spider):
     def start_requests(self):
         """Start making requests."""
         url = "http://docs.python.org/%.1f/objects.inv"
-        for v in [2.6, 3.0, 3.1]:
-            request = scrapy.Request(url % v, callback=self._parse_old_sphinx)
-            request.meta["version"] = str(v)
-            yield request
-        for v in [2.7, 3.2, 3.3, 3.4, 3.5, 3.6, 3.7, 3.8]:
-            request = scrapy.Request(url % v, callback=self._parse_new_sphinx)
+        for v in [2.6, 2.7, 3.0, 3.1, 3.2, 3.3, 3.4, 3.5, 3.6, 3.7, 3.8]:
+            request = scrapy.Request(url % v, callback=self._parse_inventory)
             request.meta["version"] = str(v)
             yield request
 
-    def _parse_old_sphinx(self, response):
-        """Parse the response for old sphinx docs."""
-        content = response.body.decode(encoding="utf-8")
-        library_metadata = [response.meta["version"]]
-        for line in content.splitlines():
-            line = line.split()
-            if line[1] == "mod":
-                yield {
-                    "library_name": line[0],
-                    "lang": "python",
-                    "library_metadata": library_metadata,
-                }
-
-    def _parse_new_sphinx(self, response):
-        """Parse the response for new sphinx docs."""
+    def _parse_inventory(self, response):
+        """Parse the response for sphinx inventories, in the format given by their header."""
         body = response.body
-        for start in range(len(body)):
-            try:
-                content = zlib.decompress(body[start:])
-                break
-            except zlib.error:
-                pass
+        if not body.startswith(INVENTORY_HEADER):
+            self.logger.error("%s is not a sphinx inventory", response.url)
+            return
+        inventory_version = body[len(INVENTORY_HEADER):body.index(b"\n")].strip()
+        if inventory_version == b"1":
+            # Old sphinx docs: 3 header lines, then plain text "name mod uri" lines
+            content, domain = body, "mod"
+        elif inventory_version == b"2":
+            # New sphinx docs: 4 header lines, then zlib compressed "name domain:role ..." lines
+            header_end = 0
+            for _ in range(4):
+                header_end = body.index(b"\n", header_end) + 1
+            content, domain = zlib.decompress(body[header_end:]), "py:module"
+        else:
+            self.logger.error(
+                "%s has unsupported sphinx inventory version %s",
+                response.url,
+                inventory_version.decode(encoding="utf-8", errors="replace"),
+            )
+            return
         library_metadata = [response.meta["version"]]
-        for line in content.decode(encoding="utf-8").splitlines()[2:]:
+        for line in content.decode(encoding="utf-8").splitlines():
+            if line.startswith("#"):
+                continue
             line = line.split()
-            if line[1] == "py:module":
+            if len(line) > 1 and line[1] == domain:
                 yield {
                     "library_name": line[0],
                     "lang": "python",
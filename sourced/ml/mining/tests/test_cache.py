@@ -0,0 +1,50 @@
+import os
+from pathlib import Path
+import tempfile
+import unittest
+
+import numpy as np
+
+from sourced.ml.mining.utils.cache import ResultCache
+from sourced.ml.mining.utils.extraction import LanguageDependencies
+
+
+def make_part(lang: str) -> LanguageDependencies:
+    return LanguageDependencies(
+        lang=lang,
+        repos=["repo"],
+        files=["file_%d" % i for i in range(100)],
+        file_repos=np.zeros(100, dtype=np.uint32),
+        deps=["dep_%d" % i for i in range(100)],
+        rows=np.arange(100, dtype=np.int32),
+        cols=np.arange(100, dtype=np.int32),
+    )
+
+
+class ResultCacheTests(unittest.TestCase):
+    def test_roundtrip(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = ResultCache(Path(tmpdir), 1 << 20)
+            self.assertIsNone(cache.get("a"))
+            cache.put("a", make_part("go"))
+            part = cache.get("a")
+            self.assertEqual(part.lang, "go")
+            self.assertEqual(part.files, make_part("go").files)
+            np.testing.assert_array_equal(part.rows, np.arange(100))
+
+    def test_evict(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            directory = Path(tmpdir)
+            # Another archive in the same directory, e.g. a checkpoint
+            make_part("go").save(directory / "go.npz")
+            cache = ResultCache(directory, 0)
+            cache.put("a", make_part("go"))
+            os.utime(str(directory / "a.cache.npz"), (0, 0))
+            cache.put("b", make_part("python"))
+            self.assertIsNone(cache.get("a"))
+            self.assertEqual(cache.get("b").lang, "python")
+            self.assertTrue((directory / "go.npz").exists())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+import unittest
+
+import numpy as np
+from scipy.sparse import csr_matrix, random as sparse_random
+
+from sourced.ml.mining.models.dependencies import (
+    pack_array,
+    pack_csr_pattern,
+    unpack_array,
+    unpack_csr_pattern,
+)
+
+
+class PackArrayTests(unittest.TestCase):
+    def test_roundtrip(self):
+        arr = np.arange(1000, dtype=np.int64) ** 2
+        for threads in (1, 4):
+            packed = pack_array(arr, threads, chunk_size=1000)
+            self.assertEqual(len(packed["chunks"]), 8)
+            unpacked = unpack_array(packed, threads)
+            self.assertEqual(unpacked.dtype, arr.dtype)
+            np.testing.assert_array_equal(unpacked, arr)
+
+    def test_empty(self):
+        unpacked = unpack_array(pack_array(np.array([], dtype=np.uint8)))
+        self.assertEqual(unpacked.dtype, np.uint8)
+        self.assertEqual(len(unpacked), 0)
+
+
+class PackCSRPatternTests(unittest.TestCase):
+    def check_roundtrip(self, matrix: csr_matrix):
+        unpacked = unpack_csr_pattern(pack_csr_pattern(matrix))
+        self.assertEqual(unpacked.shape, matrix.shape)
+        self.assertEqual(unpacked.dtype, bool)
+        self.assertTrue(unpacked.has_sorted_indices)
+        expected = csr_matrix(matrix, dtype=bool)
+        expected.eliminate_zeros()
+        self.assertEqual(unpacked.nnz, expected.nnz)
+        self.assertEqual((unpacked != expected).nnz, 0)
+
+    def test_roundtrip(self):
+        self.check_roundtrip(sparse_random(300, 200, density=0.05, format="csr", random_state=1))
+
+    def test_empty_rows(self):
+        matrix = sparse_random(50, 40, density=0.1, format="lil", random_state=2)
+        matrix[::3] = 0
+        matrix[-1] = 0
+        self.check_roundtrip(matrix.tocsr())
+
+    def test_first_index(self):
+        # Rows start with a column index lower than the last one of the previous row
+        self.check_roundtrip(csr_matrix(np.array([[0, 0, 1], [1, 0, 0], [0, 0, 0], [0, 1, 1]])))
+
+    def test_unsorted_and_explicit_zeros(self):
+        matrix = csr_matrix(
+            (np.array([1, 0, 2, 3]), np.array([2, 0, 1, 0]), np.array([0, 3, 3, 4])),
+            shape=(3, 3),
+        )
+        self.assertFalse(matrix.has_sorted_indices)
+        self.check_roundtrip(matrix)
+
+    def test_no_entries(self):
+        for shape in ((0, 0), (0, 5), (5, 0), (4, 6)):
+            with self.subTest(shape=shape):
+                self.check_roundtrip(csr_matrix(shape, dtype=np.float32))
+
+
+if __name__ == "__main__":
+    unittest.main()
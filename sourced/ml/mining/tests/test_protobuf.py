@@ -0,0 +1,73 @@
+import unittest
+
+import numpy as np
+
+from sourced.ml.mining.utils.protobuf import encode_example, encode_varint, encode_varints
+
+try:
+    import tensorflow as tf
+except ImportError:
+    tf = None
+
+
+class VarintTests(unittest.TestCase):
+    def test_encode_varint(self):
+        self.assertEqual(encode_varint(0), b"\x00")
+        self.assertEqual(encode_varint(1), b"\x01")
+        self.assertEqual(encode_varint(127), b"\x7f")
+        self.assertEqual(encode_varint(128), b"\x80\x01")
+        self.assertEqual(encode_varint(300), b"\xac\x02")
+
+    def test_encode_varints(self):
+        values = [0, 1, 127, 128, 300, 2 ** 31, 2 ** 63 - 1]
+        self.assertEqual(
+            encode_varints(np.array(values)), b"".join(encode_varint(v) for v in values)
+        )
+        self.assertEqual(encode_varints(np.array([-1])), b"\xff" * 9 + b"\x01")
+        self.assertEqual(encode_varints(np.array([], dtype=np.int64)), b"")
+
+
+class EncodeExampleTests(unittest.TestCase):
+    def test_known_bytes(self):
+        encoded = encode_example(
+            {"b": np.array([0.5]), "a": np.array([1, 300]), "c": np.array([], dtype=np.int64)}
+        )
+        self.assertEqual(
+            encoded,
+            # Example.features
+            b"\x0a\x26"
+            # Features.feature entry "a": Int64List [1, 300]
+            b"\x0a\x0c\x0a\x01a\x12\x07\x1a\x05\x0a\x03\x01\xac\x02"
+            # Features.feature entry "b": FloatList [0.5]
+            b"\x0a\x0d\x0a\x01b\x12\x08\x12\x06\x0a\x04\x00\x00\x00\x3f"
+            # Features.feature entry "c": empty Int64List
+            b"\x0a\x07\x0a\x01c\x12\x02\x1a\x00",
+        )
+
+    @unittest.skipIf(tf is None, "Tensorflow is not installed")
+    def test_tensorflow(self):
+        rng = np.random.RandomState(7)
+        features = {
+            "global_row": np.arange(100),
+            "global_col": rng.permutation(100),
+            "sparse_local_row": rng.randint(0, 100, 1000),
+            "sparse_local_col": rng.randint(0, 2 ** 40, 1000),
+            "sparse_value": rng.rand(1000).astype(np.float32),
+            "empty": np.array([], dtype=np.float32),
+        }
+
+        def feature(values):
+            if values.dtype.kind == "f":
+                return tf.train.Feature(float_list=tf.train.FloatList(value=values.tolist()))
+            return tf.train.Feature(int64_list=tf.train.Int64List(value=values.tolist()))
+
+        example = tf.train.Example(
+            features=tf.train.Features(
+                feature={key: feature(values) for key, values in features.items()}
+            )
+        )
+        self.assertEqual(encode_example(features), example.SerializeToString(deterministic=True))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+from pathlib import Path
+import unittest
+import zlib
+
+from scrapy.http import Request, Response
+
+from sourced.ml.mining.cmd.collect_stdlibs import crawler_settings
+from sourced.ml.mining.spiders import PythonStdlibSpider
+
+URL = "http://docs.python.org/3.7/objects.inv"
+INVENTORY_V1 = b"""# Sphinx inventory version 1
+# Project: Python
+# Version: 2.5
+os mod library/os.html
+os.path mod library/os.path.html
+os.getcwd function library/os.html
+"""
+INVENTORY_V2_HEADER = b"""# Sphinx inventory version 2
+# Project: Python
+# Version: 3.7
+# The remainder of this file is compressed using zlib.
+"""
+INVENTORY_V2_CONTENT = b"""os py:module 0 library/os.html#module-$ -
+os.path py:module 0 library/os.path.html#module-$ -
+os.getcwd py:function 1 library/os.html#$ -
+mod std:label -1 library/mod.html#$ Module
+"""
+
+
+def parse(body: bytes) -> list:
+    request = Request(URL, meta={"version": "3.7"})
+    return list(PythonStdlibSpider()._parse_inventory(Response(URL, body=body, request=request)))
+
+
+class PythonStdlibSpiderTests(unittest.TestCase):
+    def test_parse_inventory_v1(self):
+        items = parse(INVENTORY_V1)
+        self.assertEqual([item["library_name"] for item in items], ["os", "os.path"])
+        for item in items:
+            self.assertEqual(item["lang"], "python")
+            self.assertEqual(item["library_metadata"], ["3.7"])
+
+    def test_parse_inventory_v2(self):
+        items = parse(INVENTORY_V2_HEADER + zlib.compress(INVENTORY_V2_CONTENT))
+        self.assertEqual([item["library_name"] for item in items], ["os", "os.path"])
+        for item in items:
+            self.assertEqual(item["lang"], "python")
+            self.assertEqual(item["library_metadata"], ["3.7"])
+
+    def test_parse_inventory_unsupported_version(self):
+        body = INVENTORY_V2_HEADER.replace(b"version 2", b"version 3")
+        with self.assertLogs(PythonStdlibSpider.name, "ERROR"):
+            self.assertEqual(parse(body + zlib.compress(INVENTORY_V2_CONTENT)), [])
+
+    def test_parse_garbage(self):
+        with self.assertLogs(PythonStdlibSpider.name, "ERROR"):
+            self.assertEqual(parse(b"<html><body>Not Found</body></html>"), [])
+        with self.assertLogs(PythonStdlibSpider.name, "ERROR"):
+            self.assertEqual(parse(b""), [])
+
+
+class CrawlerSettingsTests(unittest.TestCase):
+    def test_no_cache(self):
+        settings = crawler_settings(concurrency=4)
+        self.assertEqual(settings["CONCURRENT_REQUESTS"], 4)
+        self.assertNotIn("HTTPCACHE_ENABLED", settings)
+
+    def test_cache(self):
+        settings = crawler_settings(Path("cache"))
+        self.assertTrue(settings["HTTPCACHE_ENABLED"])
+        self.assertEqual(settings["HTTPCACHE_DIR"], str(Path("cache").absolute()))
+        self.assertTrue(settings["HTTPCACHE_POLICY"].endswith(".RFC2616Policy"))
+        self.assertFalse(settings["HTTPCACHE_IGNORE_MISSING"])
+
+    def test_offline(self):
+        settings = crawler_settings(Path("cache"), offline=True)
+        self.assertTrue(settings["HTTPCACHE_POLICY"].endswith(".DummyPolicy"))
+        self.assertTrue(settings["HTTPCACHE_IGNORE_MISSING"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,45 @@
+import unittest
+
+import numpy as np
+from scipy.sparse import random as sparse_random
+
+from sourced.ml.mining.utils.swivel import split_shards
+
+
+class SplitShardsTests(unittest.TestCase):
+    def check_shards(self, matrix, row_reorder, row_nshards, col_reorder, col_nshards):
+        bounds, local_rows, local_cols, values = split_shards(
+            matrix, row_reorder, row_nshards, col_reorder, col_nshards
+        )
+        self.assertEqual(len(bounds), row_nshards * col_nshards + 1)
+        for row in range(row_nshards):
+            for col in range(col_nshards):
+                # The shards used to be sliced from the matrix
+                shard = matrix[row_reorder[row::row_nshards]][
+                    :, col_reorder[col::col_nshards]
+                ].tocoo()
+                start, end = bounds[row * col_nshards + col:row * col_nshards + col + 2]
+                np.testing.assert_array_equal(local_rows[start:end], shard.row)
+                np.testing.assert_array_equal(local_cols[start:end], shard.col)
+                np.testing.assert_array_equal(values[start:end], shard.data)
+
+    def test_square(self):
+        matrix = sparse_random(60, 60, density=0.2, format="csr", random_state=1)
+        matrix = (matrix + matrix.T).tocsr()
+        reorder = np.argsort(-np.diff(matrix.indptr))[:56]
+        self.check_shards(matrix, reorder, 4, reorder, 4)
+
+    def test_rectangular_unsorted(self):
+        matrix = sparse_random(30, 50, density=0.3, format="csr", random_state=2)
+        rng = np.random.RandomState(3)
+        for row in range(matrix.shape[0]):
+            start, end = matrix.indptr[row:row + 2]
+            order = rng.permutation(end - start)
+            matrix.indices[start:end] = matrix.indices[start:end][order]
+            matrix.data[start:end] = matrix.data[start:end][order]
+        matrix.has_sorted_indices = False
+        self.check_shards(matrix, rng.permutation(30)[:27], 3, rng.permutation(50)[:50], 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,8 +1,41 @@
 # flake8: noqa
+from sourced.ml.mining.utils.arrays import ArrayBuilder, build_csr_matrix
+from sourced.ml.mining.utils.cache import ResultCache
+from sourced.ml.mining.utils.clickhouse import table_fingerprint
+from sourced.ml.mining.utils.coocs import (
+    deps_coocs_matrix,
+    dep_tokens,
+    iter_coocs_chunks,
+    select_deps,
+)
 from sourced.ml.mining.utils.fs import (
     check_exists_filepath,
     check_empty_directory,
     check_remove_filepath,
     path_with_suffix,
 )
-from sourced.ml.mining.utils.swivel import create_swivel_inputs
+from sourced.ml.mining.utils.extraction import (
+    concat_language_dependencies,
+    extend_dependencies,
+    extract_dependencies,
+    extract_dependencies_process,
+    extract_encoded_dependencies,
+    LanguageDependencies,
+    merge_dependencies,
+)
+from sourced.ml.mining.utils.metrics import (
+    create_metrics,
+    get_metrics,
+    instrumented,
+    JSONEventsSink,
+    Metrics,
+    MetricsSink,
+    PrometheusTextfileSink,
+    use_metrics,
+)
+from sourced.ml.mining.utils.stdlibs import filter_stdlib_dependencies, stdlib_deps_mask
+from sourced.ml.mining.utils.swivel import (
+    create_swivel_inputs,
+    create_swivel_inputs_from_chunks,
+    iter_csr_chunks,
+)
@@ -0,0 +1,87 @@
+import mmap
+from typing import Tuple
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+DEFAULT_CHUNK_SIZE = 1 << 22
+
+
+class ArrayBuilder:
+    """Growable typed array. Appended values are copied into fixed-size chunks, so that growing
+    the array never copies what was already appended. The chunks are anonymous memory maps,
+    which are returned to the system as soon as they are released, whereas the allocator may
+    keep freed blocks of that size around."""
+
+    def __init__(self, dtype: np.dtype = np.int32, chunk_size: int = DEFAULT_CHUNK_SIZE):
+        self.dtype = np.dtype(dtype)
+        self.chunk_size = chunk_size
+        self._chunks = []
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def append(self, values: np.ndarray, offset: int = 0):
+        """Append an array of values shifted by an offset, cast to the builder's type."""
+        values = np.asarray(values)
+        pos = 0
+        while pos < len(values):
+            filled = self._size - (len(self._chunks) - 1) * self.chunk_size
+            if not self._chunks or filled == self.chunk_size:
+                filled = 0
+                self._chunks.append(
+                    np.frombuffer(
+                        mmap.mmap(-1, self.chunk_size * self.dtype.itemsize), dtype=self.dtype
+                    )
+                )
+            num = min(len(values) - pos, self.chunk_size - filled)
+            np.add(
+                values[pos:pos + num],
+                offset,
+                out=self._chunks[-1][filled:filled + num],
+                casting="unsafe",
+            )
+            pos += num
+            self._size += num
+
+    def build(self) -> np.ndarray:
+        """Return the contiguous array of all the appended values and empty the builder. Chunks
+        are released as soon as they are copied, so that peak memory stays close to the size of
+        the result."""
+        result = np.empty(self._size, dtype=self.dtype)
+        offset = 0
+        self._chunks.reverse()
+        while self._chunks:
+            chunk = self._chunks.pop()
+            num = min(self.chunk_size, self._size - offset)
+            result[offset:offset + num] = chunk[:num]
+            offset += num
+        self._size = 0
+        return result
+
+
+def build_csr_matrix(rows: np.ndarray, cols: np.ndarray, shape: Tuple[int, int]) -> csr_matrix:
+    """Build a boolean CSR matrix from the coordinates of its non-zero entries, dropping the
+    duplicates. The coordinates are packed into 64-bit keys which are sorted in place, so that
+    no COO matrix nor argsort permutation is ever allocated."""
+    keys = rows.astype(np.int64)
+    keys *= shape[1]
+    keys += cols
+    keys.sort()
+    if len(keys) > 1:
+        keep = np.empty(len(keys), dtype=bool)
+        keep[0] = True
+        np.not_equal(keys[1:], keys[:-1], out=keep[1:])
+        if not keep.all():
+            keys = keys[keep]
+        del keep
+    index_dtype = np.int32 if max(shape[1], len(keys)) < np.iinfo(np.int32).max else np.int64
+    indptr = np.searchsorted(keys, np.arange(shape[0] + 1, dtype=np.int64) * shape[1])
+    if len(keys):
+        keys %= shape[1]
+    indices = keys.astype(index_dtype)
+    del keys
+    return csr_matrix(
+        (np.ones(len(indices), dtype=bool), indices, indptr.astype(index_dtype)), shape=shape
+    )
@@ -0,0 +1,70 @@
+import logging
+import os
+from pathlib import Path
+from typing import Optional
+
+from sourced.ml.mining.utils.extraction import LanguageDependencies
+
+# The suffix tells the archives of the cache apart from the other ones in its directory, e.g. the
+# checkpoints of clickhouse2deps, which are never evicted
+CACHE_FILENAME = "%s.cache.npz"
+
+
+class ResultCache:
+    """On-disk cache of the dependencies extracted by queries, with one NumPy archive per key.
+    Once the archives take more than max_bytes, the least recently used ones are removed."""
+
+    def __init__(self, directory: Path, max_bytes: int, log: Optional[logging.Logger] = None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._log = log or logging.getLogger("cache")
+        directory.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, key: str) -> Path:
+        return self.directory / (CACHE_FILENAME % key)
+
+    def get(self, key: str) -> Optional[LanguageDependencies]:
+        """Return the dependencies cached under the key, or None if there are none."""
+        path = self._path(key)
+        if not path.exists():
+            return None
+        try:
+            part, cached_key = LanguageDependencies.load(path)
+        except Exception:
+            self._log.warning("Failed to read %s, removing it", path, exc_info=True)
+            path.unlink()
+            return None
+        if cached_key != key:
+            return None
+        # The modification time orders the archives by their last use for the eviction
+        os.utime(str(path))
+        return part
+
+    def put(self, key: str, part: LanguageDependencies):
+        """Cache the dependencies under the key, then evict the least recently used archives if
+        the cache is too big. The archive which was just written is never evicted."""
+        path = self._path(key)
+        part.save(path, key)
+        self.evict(keep=path)
+
+    def evict(self, keep: Optional[Path] = None):
+        """Remove the least recently used archives of the cache until it fits in max_bytes."""
+        entries = []
+        for path in self.directory.glob(CACHE_FILENAME % "*"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        size = sum(entry[1] for entry in entries)
+        for _, entry_size, path in sorted(entries):
+            if size <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            self._log.info("Evicting %s from the cache", path.name)
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            size -= entry_size
@@ -0,0 +1,119 @@
+import hashlib
+from queue import Full, Queue
+import threading
+from typing import Any, Dict, Iterator, List, Optional, Sequence
+
+from clickhouse_driver import Client
+from clickhouse_driver.result import QueryInfo
+
+from sourced.ml.mining.utils.metrics import get_metrics, Stage
+
+_PUT_TIMEOUT = 0.1
+TABLE_QUERY = (
+    "SELECT engine, metadata_modification_time FROM system.tables "
+    "WHERE database = %(database)s AND name = %(table)s"
+)
+TABLE_PARTS_QUERY = (
+    "SELECT name, modification_time, rows, bytes_on_disk FROM system.parts "
+    "WHERE database = %(database)s AND table = %(table)s AND active ORDER BY name"
+)
+_END = object()
+
+
+def iter_blocks(
+    client: Client, query: str, settings: Optional[Dict[str, Any]] = None, prefetch: int = 0
+) -> Iterator[List[Sequence]]:
+    """Execute a query and stream the result block by block. Each block is yielded as the list of
+    its columns, exactly as they were decoded by the driver, so that no row is ever materialized
+    on the Python side. If prefetch is positive, the blocks are read and decoded in a background
+    thread up to that number of blocks ahead."""
+    # The stage is looked up here since the metrics of a thread are not visible from the others
+    blocks = _iter_blocks(client, query, settings, get_metrics().current())
+    if prefetch > 0:
+        return prefetch_blocks(blocks, prefetch)
+    return blocks
+
+
+def _iter_blocks(
+    client: Client, query: str, settings: Optional[Dict[str, Any]], stage: Stage
+) -> Iterator[List[Sequence]]:
+    client.make_query_settings(dict(settings or {}))
+    client.connection.force_connect()
+    client.last_query = QueryInfo()
+    try:
+        client.connection.send_query(query)
+        client.connection.send_external_tables(None)
+    except Exception:
+        client.disconnect()
+        raise
+    for packet in client.packet_generator():
+        progress = getattr(packet, "progress", None)
+        if progress is not None:
+            stage.add(read_rows=progress.rows, read_bytes=progress.bytes)
+        block = getattr(packet, "block", None)
+        # The header block contains no rows, only the column names and types
+        if block is None or not block.rows:
+            continue
+        stage.add(blocks=1, rows=block.rows)
+        yield block.get_columns()
+
+
+def table_fingerprint(client: Client, database: str, table: str) -> Optional[str]:
+    """Compute a fingerprint of the state of a MergeTree table from its engine, the time its
+    definition changed and its active parts, which changes whenever rows are inserted, merged or
+    mutated. Return None if the table has no parts to fingerprint, e.g. for Distributed tables
+    and views, whose state cannot be known."""
+    params = {"database": database, "table": table}
+    tables = client.execute(TABLE_QUERY, params)
+    if not tables:
+        return None
+    parts = client.execute(TABLE_PARTS_QUERY, params)
+    if not parts:
+        return None
+    return hashlib.sha1(repr((tables, parts)).encode("utf-8")).hexdigest()
+
+
+def prefetch_blocks(blocks: Iterator[Any], depth: int) -> Iterator[Any]:
+    """Iterate over the blocks while a background thread fetches up to depth blocks ahead, so
+    that reading the socket and decoding overlap with the processing of the previous blocks. The
+    queue between them is bounded, so the thread waits whenever the consumer falls behind.
+    Exceptions raised while fetching are raised again by the consumer."""
+    queue = Queue(maxsize=depth)
+    stopped = threading.Event()
+
+    def put(item) -> bool:
+        while not stopped.is_set():
+            try:
+                queue.put(item, timeout=_PUT_TIMEOUT)
+                return True
+            except Full:
+                continue
+        return False
+
+    def fetch():
+        try:
+            for block in blocks:
+                if not put((block, None)):
+                    return
+            put((_END, None))
+        except BaseException as e:
+            put((_END, e))
+        finally:
+            # The generator must be closed by the thread which runs it
+            close = getattr(blocks, "close", None)
+            if close is not None:
+                close()
+
+    thread = threading.Thread(target=fetch, name="prefetch_blocks", daemon=True)
+    thread.start()
+    try:
+        while True:
+            block, error = queue.get()
+            if block is _END:
+                if error is not None:
+                    raise error
+                return
+            yield block
+    finally:
+        stopped.set()
+        thread.join()
@@ -0,0 +1,133 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import logging
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+from scipy.sparse import csc_matrix, csr_matrix
+
+from sourced.ml.mining.models import Dependencies
+from sourced.ml.mining.utils.arrays import ArrayBuilder
+
+_transposed = None
+_matrix = None
+
+
+def select_deps(
+    model: Dependencies, langs: Optional[Iterable[str]] = None, min_files: int = 1
+) -> np.ndarray:
+    """Return the sorted indices of the dependencies of the given languages (all of them if
+    None) which are imported by at least min_files files."""
+    counts = np.diff(model.csc.indptr)
+    mask = counts >= min_files
+    if langs is not None:
+        dep_langs = model.dep_langs
+        lang_codes = [
+            dep_langs.code(lang) for lang in langs if lang in dep_langs.categories
+        ]
+        mask &= np.isin(dep_langs.codes, lang_codes)
+    return np.flatnonzero(mask)
+
+
+def dep_tokens(model: Dependencies, cols: np.ndarray) -> List[str]:
+    """Return the names of the dependencies prefixed by their language, so that they are
+    unique across languages."""
+    dep_langs = model.dep_langs
+    return ["%s:%s" % (dep_langs[col], model.deps[col]) for col in cols.tolist()]
+
+
+def _init_worker(transposed: csr_matrix, matrix: csc_matrix):
+    global _transposed, _matrix
+    _transposed, _matrix = transposed, matrix
+
+
+def _coocs_block(start: int, end: int, min_coocs: int) -> csr_matrix:
+    block = (_transposed[start:end] @ _matrix).tocsr()
+    # A dependency always co-occurs with itself, the diagonal carries no information
+    rows = np.repeat(np.arange(start, end), np.diff(block.indptr))
+    block.data[block.indices == rows] = 0
+    if min_coocs > 1:
+        block.data[block.data < min_coocs] = 0
+    block.eliminate_zeros()
+    return block
+
+
+def iter_coocs_blocks(
+    matrix: csr_matrix, block_size: int = 10000, min_coocs: int = 1, workers: int = 1
+) -> Iterator[csr_matrix]:
+    """Yield the square co-occurrence matrix between the columns (dependencies) of a binary
+    file-dependency matrix, i.e. the number of files importing each pair of dependencies, by
+    blocks of block_size rows in order. Blocks are computed by the given number of worker
+    processes, with at most two blocks per worker computed ahead, so that memory stays bounded
+    by the blocks. Entries on the diagonal or lower than min_coocs are dropped."""
+    matrix = csc_matrix(matrix, dtype=np.int32)
+    transposed = matrix.T.tocsr()
+    num_deps = matrix.shape[1]
+    bounds = list(range(0, num_deps, block_size)) + [num_deps]
+    if workers > 1:
+        with ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_worker, initargs=(transposed, matrix)
+        ) as executor:
+            pending = deque()
+            for start, end in zip(bounds[:-1], bounds[1:]):
+                if len(pending) >= 2 * workers:
+                    yield pending.popleft().result()
+                pending.append(executor.submit(_coocs_block, start, end, min_coocs))
+            while pending:
+                yield pending.popleft().result()
+    else:
+        _init_worker(transposed, matrix)
+        try:
+            for start, end in zip(bounds[:-1], bounds[1:]):
+                yield _coocs_block(start, end, min_coocs)
+        finally:
+            _init_worker(None, None)
+
+
+def iter_coocs_chunks(
+    matrix: csr_matrix, block_size: int = 10000, min_coocs: int = 1, workers: int = 1
+) -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """Yield the non-zero entries of the co-occurrence matrix computed by iter_coocs_blocks() as
+    arrays of rows, columns and values, e.g. to create Swivel inputs from chunks without ever
+    holding the whole matrix."""
+    start = 0
+    for block in iter_coocs_blocks(matrix, block_size, min_coocs, workers):
+        end = start + block.shape[0]
+        yield np.repeat(np.arange(start, end), np.diff(block.indptr)), block.indices, block.data
+        start = end
+
+
+def deps_coocs_matrix(
+    matrix: csr_matrix,
+    log: logging.Logger,
+    block_size: int = 10000,
+    min_coocs: int = 1,
+    workers: int = 1,
+) -> csr_matrix:
+    """Compute the square co-occurrence matrix between the columns (dependencies) of a binary
+    file-dependency matrix, i.e. the number of files importing each pair of dependencies.
+    The product is computed by blocks of dependency rows, optionally in worker processes, so that
+    intermediate results stay bounded. The entries of each block are appended to growable arrays
+    as soon as it is computed, then the block is dropped. Entries on the diagonal or lower than
+    min_coocs are dropped."""
+    num_deps = matrix.shape[1]
+    log.info(
+        "Computing the co-occurrences of %d dependencies in %d blocks ...",
+        num_deps,
+        -(-num_deps // block_size),
+    )
+    indptr = np.zeros(num_deps + 1, dtype=np.int64)
+    indices, data = ArrayBuilder(np.int32), ArrayBuilder(np.int32)
+    start = 0
+    for block in iter_coocs_blocks(matrix, block_size, min_coocs, workers):
+        end = start + block.shape[0]
+        indptr[start + 1:end + 1] = block.indptr[1:]
+        indptr[start + 1:end + 1] += len(indices)
+        indices.append(block.indices)
+        data.append(block.data)
+        start = end
+        del block
+    index_dtype = np.int32 if len(indices) < np.iinfo(np.int32).max else np.int64
+    return csr_matrix(
+        (data.build(), indices.build(), indptr.astype(index_dtype)), shape=(num_deps, num_deps)
+    )
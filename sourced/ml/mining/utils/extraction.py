@@ -0,0 +1,438 @@
+from contextlib import closing
+from itertools import repeat
+import logging
+import os
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Sequence, Tuple
+
+from clickhouse_driver import Client
+from modelforge import merge_strings, split_strings
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from sourced.ml.mining.models import CategoricalMapping, Dependencies
+from sourced.ml.mining.utils.arrays import ArrayBuilder, build_csr_matrix
+from sourced.ml.mining.utils.clickhouse import iter_blocks
+
+
+def factorize_codes(codes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Return the position of the first occurrence of each distinct integer code, in the order
+    of these occurrences, and the number of the distinct code of each code."""
+    _, first, inverse = np.unique(codes, return_index=True, return_inverse=True)
+    order = np.argsort(first)
+    ranks = np.empty_like(order)
+    ranks[order] = np.arange(len(order))
+    return first[order], ranks[inverse.ravel()]
+
+
+def factorize(keys: Sequence) -> Tuple[np.ndarray, np.ndarray]:
+    """Factorize hashable keys like factorize_codes(). The keys are grouped by their hashes with
+    NumPy, unless distinct keys share a hash. Byte strings are thus neither padded to a common
+    width nor stripped of their trailing NUL bytes."""
+    first, inverse = factorize_codes(np.fromiter(map(hash, keys), np.int64, len(keys)))
+    # Equal keys have equal hashes, so the hashes only merge keys if they collide
+    if len(set(keys)) == len(first):
+        return first, inverse
+    index = {}
+    inverse = np.fromiter((index.setdefault(key, len(index)) for key in keys), np.int64, len(keys))
+    first = np.empty(len(index), dtype=np.int64)
+    first[inverse[::-1]] = np.arange(len(keys))[::-1]
+    return first, inverse
+
+
+class Vocabulary:
+    """Incrementally built mapping from hashable keys to dense integer indices, fed with whole
+    blocks of keys at once."""
+
+    def __init__(self):
+        self._index = {}
+
+    def __len__(self):
+        return len(self._index)
+
+    def index(self, keys: Sequence) -> np.ndarray:
+        """Return the index of each key, adding the unseen keys to the vocabulary. The keys are
+        factorized with factorize(), so only the distinct keys are looked up on the Python
+        side."""
+        first, inverse = factorize(keys)
+        return self._lookup([keys[i] for i in first.tolist()])[inverse]
+
+    def index_pairs(self, firsts: np.ndarray, seconds: Sequence) -> np.ndarray:
+        """Return the index of each (first, second) pair of keys, adding the unseen pairs to the
+        vocabulary. The firsts are integers, e.g. indices in another vocabulary, so the pairs are
+        factorized as integer codes and only the distinct pairs are looked up on the Python
+        side."""
+        second_first, second_inverse = factorize(seconds)
+        first, inverse = factorize_codes(
+            firsts.astype(np.int64) * len(second_first) + second_inverse
+        )
+        pairs = list(zip(firsts[first].tolist(), [seconds[i] for i in first.tolist()]))
+        return self._lookup(pairs)[inverse]
+
+    def _lookup(self, keys: List) -> np.ndarray:
+        """Return the index of each of the distinct keys, adding the unseen ones."""
+        ids = np.fromiter(map(self._index.get, keys, repeat(-1)), dtype=np.int64, count=len(keys))
+        unseen = np.flatnonzero(ids < 0)
+        ids[unseen] = np.arange(len(self._index), len(self._index) + len(unseen))
+        self._index.update(zip(map(keys.__getitem__, unseen.tolist()), ids[unseen].tolist()))
+        return ids
+
+    @property
+    def keys(self) -> List:
+        """Return the keys in the order of their indices."""
+        return list(self._index)
+
+
+class LanguageDependencies:
+    """Dependencies extracted for a single language, with files and dependencies indexed
+    locally."""
+
+    def __init__(
+        self,
+        lang: str,
+        repos: List[str],
+        files: List[str],
+        file_repos: np.ndarray,
+        deps: List[str],
+        rows: np.ndarray,
+        cols: np.ndarray,
+    ):
+        self.lang = lang
+        self.repos = repos
+        self.files = files
+        self.file_repos = file_repos
+        self.deps = deps
+        self.rows = rows
+        self.cols = cols
+
+    @property
+    def num_rows(self) -> int:
+        return len(self.rows)
+
+    def save(self, path: Path, key: str = ""):
+        """Atomically save the dependencies to a NumPy archive, along with a key identifying
+        how they were obtained."""
+        arrays = {"lang": np.array(self.lang), "key": np.array(key)}
+        for name in ("repos", "files", "deps"):
+            merged = merge_strings(getattr(self, name))
+            arrays[name + "_strings"] = merged["strings"]
+            arrays[name + "_lengths"] = merged["lengths"]
+        arrays.update(file_repos=self.file_repos, rows=self.rows, cols=self.cols)
+        tmp_path = path.with_name(path.name + ".tmp")
+        with tmp_path.open("wb") as fout:
+            np.savez(fout, **arrays)
+        os.replace(str(tmp_path), str(path))
+
+    @classmethod
+    def load(cls, path: Path) -> Tuple["LanguageDependencies", str]:
+        """Load the dependencies saved with save(), and return them along with their key."""
+        with np.load(str(path)) as arrays:
+            strings = {
+                name: split_strings(
+                    {
+                        "strings": arrays[name + "_strings"],
+                        "lengths": arrays[name + "_lengths"],
+                    }
+                )
+                for name in ("repos", "files", "deps")
+            }
+            part = cls(
+                lang=str(arrays["lang"]),
+                file_repos=arrays["file_repos"],
+                rows=arrays["rows"],
+                cols=arrays["cols"],
+                **strings
+            )
+            return part, str(arrays["key"])
+
+
+def decode(value: bytes) -> str:
+    return value.decode("utf-8", errors="ignore")
+
+
+class LanguageDependenciesBuilder:
+    """Build LanguageDependencies from blocks of (repo, file, dependency) columns."""
+
+    def __init__(self, lang: str):
+        self.lang = lang
+        self._repos = Vocabulary()
+        self._files = Vocabulary()
+        self._deps = Vocabulary()
+        self._rows = ArrayBuilder(np.int32)
+        self._cols = ArrayBuilder(np.int32)
+
+    def add_block(self, repos: Sequence[bytes], files: Sequence[bytes], deps: Sequence[bytes]):
+        """Factorize a block of columns and append the resulting indices."""
+        self._rows.append(self._files.index_pairs(self._repos.index(repos), files))
+        self._cols.append(self._deps.index(deps))
+
+    def build(self) -> LanguageDependencies:
+        file_keys = self._files.keys
+        return LanguageDependencies(
+            lang=self.lang,
+            repos=[decode(repo) for repo in self._repos.keys],
+            files=[decode(file) for _, file in file_keys],
+            file_repos=np.array([repo for repo, _ in file_keys], dtype=np.uint32),
+            deps=[decode(dep) for dep in self._deps.keys],
+            rows=self._rows.build(),
+            cols=self._cols.build(),
+        )
+
+
+def extract_dependencies(
+    client: Client, query: str, lang: str, settings: Dict, prefetch: int = 0
+) -> LanguageDependencies:
+    """Run the query of a language and index its result block by block, while up to prefetch
+    blocks are fetched ahead in the background."""
+    builder = LanguageDependenciesBuilder(lang)
+    settings = dict(settings, strings_as_bytes=True)
+    # Closing the blocks stops the prefetching thread even if indexing fails, so that the
+    # client is not used by the thread anymore when it is reused
+    with closing(iter_blocks(client, query, settings, prefetch)) as blocks:
+        for repos, files, deps in blocks:
+            builder.add_block(repos, files, deps)
+    return builder.build()
+
+
+def sort_vocabulary(
+    hashes: List[np.ndarray], log: logging.Logger, label: str
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Sort the server-side hashes of a vocabulary, and return them along with the order which
+    sorts the vocabulary the same way. Two distinct values sharing a hash would make the pairs
+    ambiguous, so it is checked that hashes are unique."""
+    hashes = np.concatenate(hashes or [np.array([], dtype=np.uint64)])
+    order = np.argsort(hashes, kind="stable")
+    hashes = hashes[order]
+    if len(hashes) > 1 and not (hashes[1:] != hashes[:-1]).all():
+        log.error("Hash collision in the %s vocabulary, aborting", label)
+        raise RuntimeError
+    return hashes, order
+
+
+def lookup_hashes(
+    sorted_hashes: np.ndarray, hashes: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Return the positions of the hashes in the sorted hashes of a vocabulary, along with the
+    mask of the hashes which were actually found there."""
+    inds = np.searchsorted(sorted_hashes, hashes)
+    found = inds < len(sorted_hashes)
+    found[found] = sorted_hashes[inds[found]] == hashes[found]
+    return inds, found
+
+
+def extract_encoded_dependencies(
+    client: Client, queries: Dict[str, str], lang: str, settings: Dict, prefetch: int = 0
+) -> LanguageDependencies:
+    """Run the queries of a language in which files and dependencies are encoded server-side as
+    64-bit hashes. The file and dependency vocabularies are received once each, then only the
+    (file, dependency) hash pairs, which are mapped to dense indices by binary search in the
+    sorted vocabulary hashes. Pairs whose hashes are not in the vocabularies, because the table
+    changed between the queries, are dropped with a warning. Each query runs the whole filtered
+    sub-query on the server, so this trades server time for bandwidth. Up to prefetch blocks are
+    fetched ahead in the background."""
+    log = logging.getLogger("extraction")
+    settings = dict(settings, strings_as_bytes=True)
+    repos = Vocabulary()
+    file_hashes, file_repos, files = [], [], []
+    with closing(iter_blocks(client, queries["files"], settings, prefetch)) as blocks:
+        for hashes, block_repos, block_files in blocks:
+            file_hashes.append(np.array(hashes, dtype=np.uint64))
+            file_repos.append(repos.index(block_repos))
+            files.extend(block_files)
+    file_hashes, order = sort_vocabulary(file_hashes, log, "file")
+    file_repos = np.concatenate(file_repos or [np.array([], dtype=np.int64)])[order]
+    files = [decode(files[i]) for i in order.tolist()]
+    dep_hashes, deps = [], []
+    with closing(iter_blocks(client, queries["deps"], settings, prefetch)) as blocks:
+        for hashes, block_deps in blocks:
+            dep_hashes.append(np.array(hashes, dtype=np.uint64))
+            deps.extend(block_deps)
+    dep_hashes, order = sort_vocabulary(dep_hashes, log, "dependency")
+    deps = [decode(deps[i]) for i in order.tolist()]
+    rows, cols = ArrayBuilder(np.int32), ArrayBuilder(np.int32)
+    dropped = 0
+    with closing(iter_blocks(client, queries["pairs"], settings, prefetch)) as blocks:
+        for block_files, block_deps in blocks:
+            block_files = np.array(block_files, dtype=np.uint64)
+            block_deps = np.array(block_deps, dtype=np.uint64)
+            block_rows, found = lookup_hashes(file_hashes, block_files)
+            block_cols, found_cols = lookup_hashes(dep_hashes, block_deps)
+            found &= found_cols
+            if not found.all():
+                dropped += len(found) - int(found.sum())
+                block_rows, block_cols = block_rows[found], block_cols[found]
+            rows.append(block_rows)
+            cols.append(block_cols)
+    if dropped:
+        log.warning(
+            "Dropped %d %s pairs whose file or dependency is missing from the vocabularies, "
+            "the table probably changed during the extraction",
+            dropped,
+            lang,
+        )
+    return LanguageDependencies(
+        lang=lang,
+        repos=[decode(repo) for repo in repos.keys],
+        files=files,
+        file_repos=file_repos.astype(np.uint32),
+        deps=deps,
+        rows=rows.build(),
+        cols=cols.build(),
+    )
+
+
+def extract_dependencies_process(
+    client_args: Dict[str, Any], extract: Callable[..., LanguageDependencies], *args
+) -> LanguageDependencies:
+    """Open a dedicated connection to the DB and call one of the extraction functions with it.
+    Meant to be run in a worker process."""
+    client = Client(**client_args)
+    try:
+        return extract(client, *args)
+    finally:
+        client.disconnect()
+
+
+def concat_language_dependencies(parts: Sequence[LanguageDependencies]) -> LanguageDependencies:
+    """Concatenate the dependencies of a language extracted from disjoint sets of repositories,
+    such as the buckets of a partitioned extraction. Repositories and files are appended as they
+    are, while the dependency vocabularies are merged."""
+    if len(parts) == 1:
+        return parts[0]
+    repos, files, dep_index = [], [], {}
+    file_repos = ArrayBuilder(np.uint32)
+    rows, cols = ArrayBuilder(np.int32), ArrayBuilder(np.int32)
+    for part in parts:
+        file_repos.append(part.file_repos, offset=len(repos))
+        rows.append(part.rows, offset=len(files))
+        dep_map = np.array(
+            [dep_index.setdefault(dep, len(dep_index)) for dep in part.deps], dtype=np.int64
+        )
+        cols.append(dep_map[part.cols])
+        repos.extend(part.repos)
+        files.extend(part.files)
+    return LanguageDependencies(
+        lang=parts[0].lang,
+        repos=repos,
+        files=files,
+        file_repos=file_repos.build(),
+        deps=list(dep_index),
+        rows=rows.build(),
+        cols=cols.build(),
+    )
+
+
+def categorical_codes(num_categories: int) -> np.dtype:
+    """Return the narrowest unsigned integer type able to hold the codes of the categories."""
+    return np.min_scalar_type(max(num_categories - 1, 0))
+
+
+def merge_dependencies(
+    parts: Sequence[LanguageDependencies]
+) -> Tuple[csr_matrix, List[str], List[str], CategoricalMapping, CategoricalMapping]:
+    """Merge the per-language dependencies into the Dependencies model inputs, shifting the
+    local file and dependency indices by the sizes of the preceding languages."""
+    rows, cols = ArrayBuilder(np.int32), ArrayBuilder(np.int32)
+    files, deps, lang_codes, repo_codes = [], [], [], []
+    lang_index, repo_index = {}, {}
+    for part in parts:
+        rows.append(part.rows, offset=len(files))
+        cols.append(part.cols, offset=len(deps))
+        lang_code = lang_index.setdefault(part.lang, len(lang_index))
+        lang_codes.append(np.full(len(part.files), lang_code, dtype=np.int64))
+        repo_map = np.array(
+            [repo_index.setdefault(repo, len(repo_index)) for repo in part.repos],
+            dtype=np.int64,
+        )
+        repo_codes.append(repo_map[part.file_repos])
+        files.extend(part.files)
+        deps.extend(part.deps)
+    matrix = build_csr_matrix(rows.build(), cols.build(), shape=(len(files), len(deps)))
+    ind_to_langs = CategoricalMapping(
+        list(lang_index),
+        np.concatenate(lang_codes or [np.array([], dtype=np.int64)]).astype(
+            categorical_codes(len(lang_index))
+        ),
+    )
+    ind_to_repos = CategoricalMapping(
+        list(repo_index),
+        np.concatenate(repo_codes or [np.array([], dtype=np.int64)]).astype(
+            categorical_codes(len(repo_index))
+        ),
+    )
+    return matrix, files, deps, ind_to_langs, ind_to_repos
+
+
+def extend_dependencies(
+    base: Dependencies, parts: Sequence[LanguageDependencies]
+) -> Tuple[csr_matrix, List[str], List[str], CategoricalMapping, CategoricalMapping]:
+    """Extend an existing Dependencies model with the per-language dependencies. Files and
+    dependencies which are already in the model keep their index, new ones are appended, and the
+    pairs which were extracted again are dropped when the matrix is built. Dependencies of the
+    model which no file imports are matched by name, whatever the language."""
+    files, deps = list(base.files), list(base.deps)
+    lang_index = {lang: code for code, lang in enumerate(base.inds_to_lang.categories)}
+    repo_index = {repo: code for code, repo in enumerate(base.inds_to_repo.categories)}
+    lang_codes = [base.inds_to_lang.codes.astype(np.int64)]
+    repo_codes = [base.inds_to_repo.codes.astype(np.int64)]
+    base_matrix = base.matrix.tocsc()
+    # Dependencies are specific to a language, which is the one of any file importing them
+    has_files = base_matrix.indptr[1:] > base_matrix.indptr[:-1]
+    dep_langs = np.full(len(deps), -1, dtype=np.int64)
+    dep_langs[has_files] = lang_codes[0][
+        base_matrix.indices[base_matrix.indptr[:-1][has_files]]
+    ]
+    dep_langs = [dep_langs]
+    rows, cols = ArrayBuilder(np.int32), ArrayBuilder(np.int32)
+    base_matrix = base_matrix.tocsr()
+    rows.append(np.repeat(np.arange(len(files)), np.diff(base_matrix.indptr)))
+    cols.append(base_matrix.indices)
+    del base_matrix
+    for part in parts:
+        lang_code = lang_index.setdefault(part.lang, len(lang_index))
+        repo_map = np.array(
+            [repo_index.setdefault(repo, len(repo_index)) for repo in part.repos],
+            dtype=np.int64,
+        )
+        part_repo_codes = repo_map[part.file_repos]
+        inds = np.flatnonzero(np.concatenate(lang_codes) == lang_code)
+        file_index = {
+            (repo, files[ind]): ind
+            for ind, repo in zip(inds.tolist(), np.concatenate(repo_codes)[inds].tolist())
+        }
+        file_map = np.array(
+            [
+                file_index.get(key, -1)
+                for key in zip(part_repo_codes.tolist(), part.files)
+            ],
+            dtype=np.int64,
+        )
+        new_files = np.flatnonzero(file_map < 0)
+        file_map[new_files] = np.arange(len(files), len(files) + len(new_files))
+        files.extend(part.files[ind] for ind in new_files.tolist())
+        lang_codes.append(np.full(len(new_files), lang_code, dtype=np.int64))
+        repo_codes.append(part_repo_codes[new_files])
+        all_dep_langs = np.concatenate(dep_langs)
+        # Base dependencies imported by no file have no language, they are matched by name and
+        # take the language of the part, unless the part's language has one with the same name
+        dep_index = {deps[col]: col for col in np.flatnonzero(all_dep_langs == -1).tolist()}
+        dep_index.update(
+            (deps[col], col) for col in np.flatnonzero(all_dep_langs == lang_code).tolist()
+        )
+        dep_map = np.array([dep_index.get(dep, -1) for dep in part.deps], dtype=np.int64)
+        matched = dep_map[dep_map >= 0]
+        dep_langs[0][matched[dep_langs[0][matched] == -1]] = lang_code
+        new_deps = np.flatnonzero(dep_map < 0)
+        dep_map[new_deps] = np.arange(len(deps), len(deps) + len(new_deps))
+        deps.extend(part.deps[col] for col in new_deps.tolist())
+        dep_langs.append(np.full(len(new_deps), lang_code, dtype=np.int64))
+        rows.append(file_map[part.rows])
+        cols.append(dep_map[part.cols])
+    matrix = build_csr_matrix(rows.build(), cols.build(), shape=(len(files), len(deps)))
+    ind_to_langs = CategoricalMapping(
+        list(lang_index), np.concatenate(lang_codes).astype(categorical_codes(len(lang_index)))
+    )
+    ind_to_repos = CategoricalMapping(
+        list(repo_index), np.concatenate(repo_codes).astype(categorical_codes(len(repo_index)))
+    )
+    return matrix, files, deps, ind_to_langs, ind_to_repos
@@ -0,0 +1,251 @@
+from contextlib import contextmanager
+import cProfile
+import functools
+import json
+import os
+from pathlib import Path
+import re
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence
+
+DEFAULT_PROMETHEUS_PREFIX = "srcdmine"
+TRACEMALLOC_TOP_LINES = 25
+
+
+def peak_rss() -> int:
+    """Return the peak resident set size of the process in bytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class Stage:
+    """Measurements of a running stage: counters are summed, their rate per second is computed
+    when the stage ends, and gauges such as dictionary sizes keep their last value."""
+
+    def __init__(self, name: str, labels: Dict[str, str]):
+        self.name = name
+        self.labels = labels
+        self.counters = {}
+        self.gauges = {}
+        self.start = time.time()
+        self._start = time.perf_counter()
+
+    def add(self, **counters: int):
+        for key, value in counters.items():
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, **gauges: float):
+        self.gauges.update(gauges)
+
+    def event(self) -> Dict[str, Any]:
+        seconds = time.perf_counter() - self._start
+        return {
+            "stage": self.name,
+            "labels": self.labels,
+            "start": self.start,
+            "seconds": seconds,
+            "counters": dict(self.counters),
+            "rates": {
+                "%s_per_second" % key: value / seconds if seconds > 0 else 0.0
+                for key, value in self.counters.items()
+            },
+            # The peak RSS is the one of the whole process up to the end of the stage
+            "gauges": dict(self.gauges, peak_rss_bytes=peak_rss()),
+        }
+
+
+class MetricsSink:
+    """Destination of the events emitted by Metrics when stages end."""
+
+    def emit(self, event: Dict[str, Any]):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class JSONEventsSink(MetricsSink):
+    """Append each event as a line of JSON to a file."""
+
+    def __init__(self, path: Path):
+        self._fout = path.open("a", buffering=1)
+
+    def emit(self, event: Dict[str, Any]):
+        self._fout.write(json.dumps(event, sort_keys=True) + "\n")
+
+    def close(self):
+        self._fout.close()
+
+
+class PrometheusTextfileSink(MetricsSink):
+    """Keep the last event of each stage as gauges in a file in the Prometheus text format, e.g.
+    for the textfile collector of the node exporter. The file is replaced atomically after each
+    event."""
+
+    def __init__(self, path: Path, prefix: str = DEFAULT_PROMETHEUS_PREFIX):
+        self.path = path
+        self.prefix = prefix
+        self._events = {}
+
+    @staticmethod
+    def _name(name: str) -> str:
+        return re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+    @staticmethod
+    def _labels(labels: Dict[str, str]) -> str:
+        return ",".join(
+            '%s="%s"'
+            % (
+                PrometheusTextfileSink._name(key),
+                str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'),
+            )
+            for key, value in sorted(labels.items())
+        )
+
+    def emit(self, event: Dict[str, Any]):
+        key = (event["stage"], tuple(sorted(event["labels"].items())))
+        self._events[key] = event
+        self._write()
+
+    def _write(self):
+        samples = {}
+        for event in self._events.values():
+            labels = self._labels(dict(event["labels"], stage=event["stage"]))
+            values = {
+                "seconds": event["seconds"],
+                "end_timestamp_seconds": event["start"] + event["seconds"],
+            }
+            values.update(event["counters"])
+            values.update(event["rates"])
+            values.update(event["gauges"])
+            for name, value in values.items():
+                name = "%s_stage_%s" % (self.prefix, self._name(name))
+                samples.setdefault(name, []).append("%s{%s} %r" % (name, labels, float(value)))
+        lines = []
+        for name in sorted(samples):
+            lines.append("# TYPE %s gauge" % name)
+            lines.extend(samples[name])
+        tmp_path = self.path.with_name(".%s.tmp" % self.path.name)
+        with tmp_path.open("w") as fout:
+            fout.write("\n".join(lines) + "\n")
+        os.replace(str(tmp_path), str(self.path))
+
+
+class Metrics:
+    """Record the timings, counters and gauges of the stages of a command and pass them to the
+    sinks. If profile_dir is set, each outermost stage is also run under cProfile and
+    tracemalloc, and their results are written to that directory."""
+
+    def __init__(self, sinks: Sequence[MetricsSink] = (), profile_dir: Optional[Path] = None):
+        self.sinks = list(sinks)
+        self.profile_dir = profile_dir
+        self._local = threading.local()
+
+    def _stack(self) -> List[Stage]:
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    def current(self) -> Stage:
+        """Return the innermost running stage of the thread, or a detached one if there is
+        none, so that instrumented code never needs to check."""
+        stack = self._stack()
+        return stack[-1] if stack else Stage("", {})
+
+    @contextmanager
+    def stage(self, name: str, **labels: str) -> Iterator[Stage]:
+        stack = self._stack()
+        stage = Stage(name, {key: str(value) for key, value in labels.items()})
+        profile = self.profile_dir is not None and not stack
+        if profile:
+            profiler = cProfile.Profile()
+            started_tracing = not tracemalloc.is_tracing()
+            if started_tracing:
+                tracemalloc.start()
+            elif hasattr(tracemalloc, "reset_peak"):
+                tracemalloc.reset_peak()
+            profiler.enable()
+        stack.append(stage)
+        try:
+            yield stage
+        finally:
+            stack.pop()
+            if profile:
+                profiler.disable()
+                self._save_profile(stage, profiler, started_tracing)
+            event = stage.event()
+            for sink in self.sinks:
+                sink.emit(event)
+
+    def _save_profile(self, stage: Stage, profiler: cProfile.Profile, stop_tracing: bool):
+        self.profile_dir.mkdir(parents=True, exist_ok=True)
+        stem = "-".join([stage.name] + [value for _, value in sorted(stage.labels.items())])
+        stem = re.sub(r"[^a-zA-Z0-9_.-]", "_", stem)
+        profiler.dump_stats(str(self.profile_dir / ("%s.prof" % stem)))
+        snapshot = tracemalloc.take_snapshot()
+        stage.set(tracemalloc_peak_bytes=tracemalloc.get_traced_memory()[1])
+        if stop_tracing:
+            tracemalloc.stop()
+        with (self.profile_dir / ("%s.tracemalloc.txt" % stem)).open("w") as fout:
+            for stat in snapshot.statistics("lineno")[:TRACEMALLOC_TOP_LINES]:
+                fout.write("%s\n" % stat)
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+
+_metrics = Metrics()
+
+
+def get_metrics() -> Metrics:
+    """Return the metrics of the running command, which have no sinks by default."""
+    return _metrics
+
+
+@contextmanager
+def use_metrics(metrics: Metrics) -> Iterator[Metrics]:
+    """Make the metrics those of the running command, then close them."""
+    global _metrics
+    previous, _metrics = _metrics, metrics
+    try:
+        yield metrics
+    finally:
+        _metrics = previous
+        metrics.close()
+
+
+def create_metrics(
+    json_path: Optional[Path] = None,
+    prometheus_path: Optional[Path] = None,
+    profile_dir: Optional[Path] = None,
+) -> Metrics:
+    """Create the metrics with the sinks given by the command line arguments."""
+    sinks = []
+    if json_path is not None:
+        sinks.append(JSONEventsSink(json_path))
+    if prometheus_path is not None:
+        sinks.append(PrometheusTextfileSink(prometheus_path))
+    return Metrics(sinks, profile_dir)
+
+
+def instrumented(handler: Callable) -> Callable:
+    """Decorate a command handler to run it with the metrics given by the --metrics-json,
+    --metrics-prometheus and --profile arguments, if any."""
+
+    @functools.wraps(handler)
+    def wrapped_handler(args):
+        metrics = create_metrics(
+            getattr(args, "metrics_json", None),
+            getattr(args, "metrics_prometheus", None),
+            getattr(args, "profile", None),
+        )
+        with use_metrics(metrics):
+            return handler(args)
+
+    return wrapped_handler
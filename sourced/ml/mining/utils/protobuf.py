@@ -0,0 +1,76 @@
+from typing import Dict
+
+import numpy as np
+
+# Protocol buffers wire types and the field numbers of tensorflow/core/example/{example,feature}
+WIRE_LENGTH_DELIMITED = 2
+EXAMPLE_FEATURES = 1
+FEATURES_FEATURE = 1
+MAP_KEY, MAP_VALUE = 1, 2
+FEATURE_FLOAT_LIST, FEATURE_INT64_LIST = 2, 3
+LIST_VALUE = 1
+MAX_VARINT_SIZE = 10
+
+
+def encode_varint(value: int) -> bytes:
+    """Encode a non-negative integer as a protobuf varint."""
+    result = bytearray()
+    while value > 0x7F:
+        result.append((value & 0x7F) | 0x80)
+        value >>= 7
+    result.append(value)
+    return bytes(result)
+
+
+def encode_varints(values: np.ndarray) -> bytes:
+    """Encode an array of integers as consecutive protobuf varints, one byte position at a time
+    for all the values at once. Negative values take 10 bytes, as int64 fields do."""
+    values = np.asarray(values).astype(np.int64).view(np.uint64)
+    sizes = np.ones(len(values), dtype=np.int64)
+    for shift in range(7, 7 * MAX_VARINT_SIZE, 7):
+        sizes += values >= np.uint64(1 << shift)
+    offsets = np.cumsum(sizes) - sizes
+    result = np.empty(int(sizes.sum()), dtype=np.uint8)
+    for pos in range(MAX_VARINT_SIZE):
+        mask = sizes > pos
+        if not mask.any():
+            break
+        chunk = (values[mask] >> np.uint64(7 * pos)) & np.uint64(0x7F)
+        chunk |= (sizes[mask] > pos + 1).astype(np.uint64) << np.uint64(7)
+        result[offsets[mask] + pos] = chunk
+    return result.tobytes()
+
+
+def encode_field(number: int, payload: bytes) -> bytes:
+    """Encode a length-delimited field: a message, a string or a packed repeated field."""
+    return (
+        encode_varint((number << 3) | WIRE_LENGTH_DELIMITED)
+        + encode_varint(len(payload))
+        + payload
+    )
+
+
+def encode_feature(values: np.ndarray) -> bytes:
+    """Encode a tf.train.Feature holding a FloatList if the values are floating point, and an
+    Int64List otherwise."""
+    values = np.asarray(values)
+    if values.dtype.kind == "f":
+        kind, payload = FEATURE_FLOAT_LIST, values.astype("<f4").tobytes()
+    else:
+        kind, payload = FEATURE_INT64_LIST, encode_varints(values)
+    # Packed repeated fields are omitted when empty, but the list message itself is set
+    return encode_field(kind, encode_field(LIST_VALUE, payload) if len(values) else b"")
+
+
+def encode_example(features: Dict[str, np.ndarray]) -> bytes:
+    """Encode a tf.train.Example straight from NumPy arrays. The output is byte-identical to
+    the deterministic serialization of the Example, in which map entries are sorted by key."""
+    entries = b"".join(
+        encode_field(
+            FEATURES_FEATURE,
+            encode_field(MAP_KEY, key.encode("utf-8"))
+            + encode_field(MAP_VALUE, encode_feature(features[key])),
+        )
+        for key in sorted(features)
+    )
+    return encode_field(EXAMPLE_FEATURES, entries)
@@ -0,0 +1,46 @@
+import logging
+
+import numpy as np
+
+from sourced.ml.mining.models import Dependencies, StandardLibraries
+
+
+def stdlib_deps_mask(
+    model: Dependencies, stdlibs: StandardLibraries, prefixes: bool = True
+) -> np.ndarray:
+    """Return the mask of the dependencies which belong to the standard library of their
+    language, classifying the dependencies of each language in a single batch."""
+    dep_langs = model.dep_langs
+    mask = np.zeros(len(model.deps), dtype=bool)
+    for lang in dep_langs.categories:
+        if lang not in stdlibs.langs:
+            continue
+        inds = dep_langs.indices(lang)
+        mask[inds] = stdlibs.classify(
+            lang, (model.deps[ind] for ind in inds.tolist()), prefixes
+        )
+    return mask
+
+
+def filter_stdlib_dependencies(
+    model: Dependencies,
+    stdlibs: StandardLibraries,
+    annotate: bool = False,
+    prefixes: bool = True,
+    log_level: int = logging.INFO,
+) -> Dependencies:
+    """Return a model without the standard library dependencies, or with all of them and the
+    mask of the standard library ones if annotate is True. Only the columns of the matrix and
+    the list of dependencies are sliced, the files, languages and repositories are shared with
+    the original model."""
+    mask = stdlib_deps_mask(model, stdlibs, prefixes)
+    if annotate:
+        matrix, deps, stdlib_mask = model.matrix, model.deps, mask
+    else:
+        cols = np.flatnonzero(~mask)
+        matrix = model.csc[:, cols].tocsr()
+        deps = [model.deps[ind] for ind in cols.tolist()]
+        stdlib_mask = None
+    return Dependencies(log_level=log_level).construct(
+        matrix, model.files, deps, model.inds_to_lang, model.inds_to_repo, stdlib_mask
+    )
@@ -1,43 +1,39 @@
+from concurrent.futures import as_completed, FIRST_COMPLETED, ProcessPoolExecutor, wait
 import logging
 from pathlib import Path
 import shutil
-from typing import List, Optional
-import warnings
+import tempfile
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
 
 import numpy as np
 from scipy.sparse import csr_matrix
-import tqdm
+from tqdm import tqdm
 
-try:
-    import tensorflow as tf
-except ImportError:
-    warnings.warn(
-        "Tensorflow is not installed, dependent functionality is unavailable."
-    )
+from sourced.ml.mining.utils.metrics import get_metrics
+from sourced.ml.mining.utils.protobuf import encode_example
 
 VOCABULARY_FILENAME = "%s_vocab.txt"
 SUMS_FILENAME = "%s_sums.txt"
 SHARDS_FILENAME = "shard-%03d-%03d.pb"
+SPILL_FILENAME = "spill-%03d.bin"
+SPILL_DTYPE = np.dtype([("row", np.int64), ("col", np.int64), ("value", np.float32)])
+DEFAULT_CHUNK_ROWS = 1 << 16
+DEFAULT_BUFFER_SIZE = 1 << 22
 
-
-def format_int_list(vs: List[int]):
-    return tf.train.Feature(int64_list=tf.train.Int64List(value=list(vs)))
-
-
-def format_float_list(vs: List[float]):
-    return tf.train.Feature(float_list=tf.train.FloatList(value=list(vs)))
+COOChunk = Tuple[np.ndarray, np.ndarray, np.ndarray]
 
 
 def create_vocabulary_sums_inputs(
     output_dir: Path,
     label: str,
     log: logging.Logger,
-    indptr: np.ndarray,
+    bool_sums: np.ndarray,
     shard_size: int,
     vocab: List,
 ) -> np.ndarray:
-    """Create and save the Swivel inputs for either the column or row vocabulary, then return the
-    new order to be used when creating the matrix."""
+    """Create and save the Swivel inputs for either the column or row vocabulary, given the
+    number of non-zero entries of each row or column, then return the new order to be used when
+    creating the matrix."""
     vocab_size = len(vocab)
     if vocab_size < shard_size:
         log.error(
@@ -48,7 +44,6 @@ def create_vocabulary_sums_inputs(
         )
         raise RuntimeError
     log.info("Reordering the vocabulary in descending order of feature frequency ...")
-    bool_sums = indptr[1:] - indptr[:-1]
     reorder = np.argsort(-bool_sums)
     vocab_size -= vocab_size % shard_size
     num_removed = len(reorder) - vocab_size
@@ -62,47 +57,102 @@ def create_vocabulary_sums_inputs(
         reorder = reorder[:vocab_size]
     vocab_output_path = output_dir / (VOCABULARY_FILENAME % label)
     log.info("Saving the vocabulary to %s ...", vocab_output_path)
-    with vocab_output_path.open() as fout:
+    with vocab_output_path.open("w") as fout:
         fout.write("\n".join(vocab))
     sums_output_path = output_dir / (SUMS_FILENAME % label)
     log.info("Saving the sums to %s ...", sums_output_path)
-    with sums_output_path.open() as fout:
+    with sums_output_path.open("w") as fout:
         fout.write("\n".join(map(str, bool_sums.tolist())))
     return reorder
 
 
-def create_swivel_inputs(
+def split_shards(
+    coocs_matrix: csr_matrix,
+    row_reorder: np.ndarray,
+    row_nshards: int,
+    col_reorder: np.ndarray,
+    col_nshards: int,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Assign all the non-zero entries of the matrix to their shard in a single vectorized pass.
+    The row of rank r in row_reorder goes to the row shard r % row_nshards, at the local row
+    r // row_nshards, and likewise for columns. Return the entries sorted by shard then local row,
+    along with the boundaries of each shard. The entries of a local row keep their order in the
+    matrix, as when the shards are sliced from it."""
+    coocs = coocs_matrix.tocoo()
+    row_ranks = np.full(coocs_matrix.shape[0], -1, dtype=np.int64)
+    row_ranks[row_reorder] = np.arange(len(row_reorder))
+    col_ranks = np.full(coocs_matrix.shape[1], -1, dtype=np.int64)
+    col_ranks[col_reorder] = np.arange(len(col_reorder))
+    row_ranks, col_ranks = row_ranks[coocs.row], col_ranks[coocs.col]
+    # Entries of the rows and columns removed from the vocabularies are dropped
+    kept = (row_ranks >= 0) & (col_ranks >= 0)
+    row_ranks, col_ranks, values = row_ranks[kept], col_ranks[kept], coocs.data[kept]
+    del coocs, kept
+    shard_rows = len(row_reorder) // row_nshards
+    shards = (row_ranks % row_nshards) * col_nshards + col_ranks % col_nshards
+    local_rows, local_cols = row_ranks // row_nshards, col_ranks // col_nshards
+    del row_ranks, col_ranks
+    order = np.argsort(shards * shard_rows + local_rows, kind="stable")
+    bounds = np.searchsorted(shards[order], np.arange(row_nshards * col_nshards + 1))
+    return bounds, local_rows[order], local_cols[order], values[order]
+
+
+def write_shard(
+    path: Path,
+    indices_row: np.ndarray,
+    indices_col: np.ndarray,
+    local_rows: np.ndarray,
+    local_cols: np.ndarray,
+    values: np.ndarray,
+):
+    """Serialize a shard as a tf.train.Example, encoded straight from the arrays, and write it
+    to the given path."""
+    shard = encode_example(
+        {
+            "global_row": indices_row,
+            "global_col": indices_col,
+            "sparse_local_row": local_rows,
+            "sparse_local_col": local_cols,
+            "sparse_value": values.astype(np.float32),
+        }
+    )
+    with path.open(mode="wb") as fout:
+        fout.write(shard)
+
+
+def create_vocabularies_sums_inputs(
     output_dir: Path,
     log: logging.Logger,
-    coocs_matrix: csr_matrix,
+    shape: Tuple[int, int],
+    row_sums: np.ndarray,
+    col_sums: Optional[np.ndarray],
     shard_size: int,
     row_vocab: List,
     col_vocab: Optional[List] = None,
-):
-    """Create and save Swivel inputs from a given co-occurence matrix. If column vocabulary is not
-    given, the matrix must be square (and should be symmetrical)."""
-
-    if coocs_matrix.shape[0] != len(row_vocab):
+) -> Tuple[np.ndarray, int, np.ndarray, int]:
+    """Check the vocabularies against the shape of the matrix, create and save the Swivel inputs
+    for both of them, then return the order and the number of shards of rows and columns."""
+    if shape[0] != len(row_vocab):
         log.error("Row vocabulary and matrix shape do not match, aborting")
         raise RuntimeError
 
-    if col_vocab and coocs_matrix.shape[1] != len(col_vocab):
+    if col_vocab and shape[1] != len(col_vocab):
         log.error("Column vocabulary and matrix shape do not match, aborting")
         raise RuntimeError
-    elif not col_vocab and coocs_matrix.shape[0] != coocs_matrix.shape[1]:
+    elif not col_vocab and shape[0] != shape[1]:
         log.error(
             "Co-occurence matrix is not square but no column vocabulary was provided, aborting"
         )
         raise RuntimeError
     log.info("Creating and saving the rows vocabulary and sums ... ")
     row_reorder = create_vocabulary_sums_inputs(
-        output_dir, "row", log, coocs_matrix.indptr, shard_size, row_vocab
+        output_dir, "row", log, row_sums, shard_size, row_vocab
     )
     row_nshards = len(row_reorder) // shard_size
     if col_vocab:
         log.info("Creating and saving the columns vocabulary and sums ... ")
         col_reorder = create_vocabulary_sums_inputs(
-            output_dir, "col", log, coocs_matrix.tocsc().indptr, shard_size, col_vocab
+            output_dir, "col", log, col_sums, shard_size, col_vocab
         )
         col_nshards = len(col_reorder) // shard_size
     else:
@@ -113,28 +163,232 @@ def create_swivel_inputs(
             col_filepath = (output_dir / (filename % "col")).as_posix()
             log.info("Copying %s to %s ...", row_filepath, col_filepath)
             shutil.copyfile(row_filepath, col_filepath)
+    return row_reorder, row_nshards, col_reorder, col_nshards
+
+
+def create_swivel_inputs(
+    output_dir: Path,
+    log: logging.Logger,
+    coocs_matrix: csr_matrix,
+    shard_size: int,
+    row_vocab: List,
+    col_vocab: Optional[List] = None,
+    workers: int = 1,
+):
+    """Create and save Swivel inputs from a given co-occurence matrix. If column vocabulary is not
+    given, the matrix must be square (and should be symmetrical). The shards are serialized by
+    the given number of worker processes."""
+    metrics = get_metrics()
+    with metrics.stage("swivel_vocabularies") as stage:
+        row_reorder, row_nshards, col_reorder, col_nshards = create_vocabularies_sums_inputs(
+            output_dir,
+            log,
+            coocs_matrix.shape,
+            np.diff(coocs_matrix.indptr),
+            np.bincount(coocs_matrix.indices, minlength=coocs_matrix.shape[1]),
+            shard_size,
+            row_vocab,
+            col_vocab,
+        )
+        stage.set(row_vocab=len(row_reorder), col_vocab=len(col_reorder))
     n_shards = row_nshards * col_nshards
+    log.info("Assigning the non-zero entries to the %d shards ...", n_shards)
+    with metrics.stage("swivel_split") as stage:
+        bounds, local_rows, local_cols, values = split_shards(
+            coocs_matrix, row_reorder, row_nshards, col_reorder, col_nshards
+        )
+        stage.add(entries=len(values))
     log.info("Creating and saving the %d shards ...", n_shards)
-    with tqdm(total=n_shards) as progress:
-        for row in range(row_nshards):
-            indices_row = row_reorder[row::row_nshards]
-            for col in range(col_nshards):
-                indices_col = col_reorder[col::col_nshards]
-                shard = coocs_matrix[indices_row][:, indices_col].tocoo()
-                tf_shard = tf.train.Example(
-                    features=tf.train.Features(
-                        feature={
-                            "global_row": format_int_list(indices_row),
-                            "global_col": format_int_list(indices_col),
-                            "sparse_local_row": format_int_list(shard.row),
-                            "sparse_local_col": format_int_list(shard.col),
-                            "sparse_value": format_float_list(shard.data),
-                        }
-                    )
-                )
-                with (output_dir / (SHARDS_FILENAME % (row, col))).open(
-                    mode="rb"
-                ) as fout:
-                    fout.write(tf_shard.SerializeToString())
 
+    def shard_args(shard):
+        row, col = divmod(shard, col_nshards)
+        start, end = bounds[shard], bounds[shard + 1]
+        return (
+            output_dir / (SHARDS_FILENAME % (row, col)),
+            row_reorder[row::row_nshards],
+            col_reorder[col::col_nshards],
+            local_rows[start:end],
+            local_cols[start:end],
+            values[start:end],
+        )
+
+    with metrics.stage("swivel_write", workers=workers) as stage, tqdm(
+        total=n_shards
+    ) as progress:
+        stage.add(entries=len(values))
+        if workers <= 1:
+            for shard in range(n_shards):
+                write_shard(*shard_args(shard))
                 progress.update(1)
+                stage.add(shards=1)
+            return
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # Bound the number of queued shards so that their copies do not pile up in memory
+            pending = set()
+            for shard in range(n_shards):
+                if len(pending) >= 2 * workers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+                        progress.update(1)
+                        stage.add(shards=1)
+                pending.add(executor.submit(write_shard, *shard_args(shard)))
+            for future in as_completed(pending):
+                future.result()
+                progress.update(1)
+                stage.add(shards=1)
+
+
+def iter_csr_chunks(
+    matrix: csr_matrix, chunk_rows: int = DEFAULT_CHUNK_ROWS
+) -> Iterator[COOChunk]:
+    """Iterate over the non-zero entries of a CSR matrix by blocks of rows, as arrays of rows,
+    columns and values. The matrix is never copied whole, so that a memory-mapped matrix is only
+    read one block at a time."""
+    for start in range(0, matrix.shape[0], chunk_rows):
+        end = min(start + chunk_rows, matrix.shape[0])
+        indptr = np.asarray(matrix.indptr[start:end + 1])
+        rows = np.repeat(np.arange(start, end), np.diff(indptr))
+        yield (
+            rows,
+            np.asarray(matrix.indices[indptr[0]:indptr[-1]]),
+            np.asarray(matrix.data[indptr[0]:indptr[-1]]),
+        )
+
+
+def write_row_shards(
+    output_dir: Path,
+    spill_path: Path,
+    row: int,
+    indices_row: np.ndarray,
+    col_reorder: np.ndarray,
+    col_nshards: int,
+):
+    """Read the entries of a row shard from its spill file, split them by column shard and
+    write the shards of that row. The entries of a local row keep their order in the spill file,
+    which is their order in the matrix."""
+    if spill_path.exists():
+        entries = np.fromfile(spill_path.as_posix(), dtype=SPILL_DTYPE)
+    else:
+        entries = np.empty(0, dtype=SPILL_DTYPE)
+    col_shards, local_cols = np.divmod(entries["col"], col_nshards)[::-1]
+    order = np.lexsort((entries["row"], col_shards))
+    bounds = np.searchsorted(col_shards[order], np.arange(col_nshards + 1))
+    local_rows, local_cols = entries["row"][order], local_cols[order]
+    values = entries["value"][order]
+    del entries, col_shards, order
+    for col in range(col_nshards):
+        start, end = bounds[col], bounds[col + 1]
+        write_shard(
+            output_dir / (SHARDS_FILENAME % (row, col)),
+            indices_row,
+            col_reorder[col::col_nshards],
+            local_rows[start:end],
+            local_cols[start:end],
+            values[start:end],
+        )
+
+
+def create_swivel_inputs_from_chunks(
+    output_dir: Path,
+    log: logging.Logger,
+    chunks: Callable[[], Iterable[COOChunk]],
+    shape: Tuple[int, int],
+    shard_size: int,
+    row_vocab: List,
+    col_vocab: Optional[List] = None,
+    workers: int = 1,
+    spill_dir: Optional[Path] = None,
+    buffer_size: int = DEFAULT_BUFFER_SIZE,
+):
+    """Create and save Swivel inputs from a co-occurence matrix which does not fit in memory.
+    chunks() must return a new iterator over the non-zero entries of the matrix as arrays of
+    rows, columns and values, e.g. iter_csr_chunks() of a memory-mapped matrix. The first pass
+    counts the entries of each row and column, the second one appends them to one spill file per
+    row shard in spill_dir (output_dir by default) whenever buffer_size entries are buffered.
+    The spill files are then split by column shard one at a time, by the given number of worker
+    processes, so that memory is bounded by the buffers and the size of a row shard."""
+    metrics = get_metrics()
+    log.info("Counting the non-zero entries of each row and column ...")
+    row_sums = np.zeros(shape[0], dtype=np.int64)
+    col_sums = np.zeros(shape[1], dtype=np.int64)
+    with metrics.stage("swivel_count") as stage:
+        for rows, cols, _ in chunks():
+            row_sums += np.bincount(rows, minlength=shape[0])
+            col_sums += np.bincount(cols, minlength=shape[1])
+            stage.add(entries=len(rows))
+    with metrics.stage("swivel_vocabularies") as stage:
+        row_reorder, row_nshards, col_reorder, col_nshards = create_vocabularies_sums_inputs(
+            output_dir, log, shape, row_sums, col_sums, shard_size, row_vocab, col_vocab
+        )
+        stage.set(row_vocab=len(row_reorder), col_vocab=len(col_reorder))
+    del row_sums, col_sums
+    row_ranks = np.full(shape[0], -1, dtype=np.int64)
+    row_ranks[row_reorder] = np.arange(len(row_reorder))
+    col_ranks = np.full(shape[1], -1, dtype=np.int64)
+    col_ranks[col_reorder] = np.arange(len(col_reorder))
+    with tempfile.TemporaryDirectory(dir=(spill_dir or output_dir).as_posix()) as tmpdir:
+        spill_paths = [Path(tmpdir) / (SPILL_FILENAME % row) for row in range(row_nshards)]
+        buffers = [[] for _ in range(row_nshards)]
+        buffered = 0
+
+        def flush():
+            for path, buffer in zip(spill_paths, buffers):
+                if buffer:
+                    with path.open(mode="ab") as fout:
+                        for entries in buffer:
+                            entries.tofile(fout)
+                    buffer.clear()
+
+        log.info("Spilling the non-zero entries to the %d row shards ...", row_nshards)
+        with metrics.stage("swivel_spill") as stage:
+            for rows, cols, values in chunks():
+                rows, cols = row_ranks[rows], col_ranks[cols]
+                # Entries of the rows and columns removed from the vocabularies are dropped
+                kept = (rows >= 0) & (cols >= 0)
+                shards, local_rows = np.divmod(rows[kept], row_nshards)[::-1]
+                order = np.argsort(shards, kind="stable")
+                entries = np.empty(len(order), dtype=SPILL_DTYPE)
+                entries["row"] = local_rows[order]
+                entries["col"] = cols[kept][order]
+                entries["value"] = values[kept][order]
+                bounds = np.searchsorted(shards[order], np.arange(row_nshards + 1))
+                for row in np.flatnonzero(np.diff(bounds)).tolist():
+                    buffers[row].append(entries[bounds[row]:bounds[row + 1]])
+                buffered += len(entries)
+                stage.add(entries=len(entries), bytes=entries.nbytes)
+                if buffered >= buffer_size:
+                    flush()
+                    buffered = 0
+            flush()
+        del row_ranks, col_ranks
+        log.info("Creating and saving the %d shards ...", row_nshards * col_nshards)
+
+        def row_shard_args(row):
+            return (
+                output_dir,
+                spill_paths[row],
+                row,
+                row_reorder[row::row_nshards],
+                col_reorder,
+                col_nshards,
+            )
+
+        with metrics.stage("swivel_write", workers=workers) as stage, tqdm(
+            total=row_nshards
+        ) as progress:
+            if workers <= 1:
+                for row in range(row_nshards):
+                    write_row_shards(*row_shard_args(row))
+                    progress.update(1)
+                    stage.add(shards=col_nshards)
+                return
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = [
+                    executor.submit(write_row_shards, *row_shard_args(row))
+                    for row in range(row_nshards)
+                ]
+                for future in as_completed(futures):
+                    future.result()
+                    progress.update(1)
+                    stage.add(shards=col_nshards)